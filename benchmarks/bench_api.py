@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Offline load benchmark for the API. Starts the stand-in upstream and a fake
+# Gemini from stubs.py, serves the app on a local port, drives every endpoint
+# at each concurrency level and reports throughput and p50/p95/p99 latency.
+# Results are saved as JSON, and --compare prints the change against an
+# earlier results file.
+#
+#   python benchmarks/bench_api.py --concurrency 1 8 32 --output results.json
+#   python benchmarks/bench_api.py --compare results.json
+#   python benchmarks/bench_api.py --serve async --concurrency 256   (needs aiohttp)
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import requests
+from werkzeug.serving import make_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from stubs import FakeGemini, StubUpstream
+
+OPERATIONS = ['put', 'get', 'patch', 'departures', 'delete']
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+# Run `count` calls of `call(i)` on `concurrency` threads and time each one
+def run_load(call, count, concurrency):
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = call(session, i)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(count)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': round(count / wall, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent.parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(args):
+    import z5312750 as app_module
+
+    stub = StubUpstream(latency=args.upstream_latency / 1000, departures=args.departures).start()
+    app = app_module.create_app({
+        'db_file': os.path.join(tempfile.mkdtemp(), 'bench_api.db'),
+        'transport_base_url': stub.url,
+        # the stub has no quota, don't let the limiter be what we measure
+        'upstream_rate_per_minute': 1e9,
+        'upstream_burst': 1000000,
+        'upstream_pool_size': max(args.concurrency),
+    })
+    fake_gemini = FakeGemini(latency=args.gemini_latency / 1000)
+    app_module.gemini = fake_gemini
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if args.serve == 'async':
+        base, shutdown = serve_async(app_module.create_async_app())
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_port}'
+        shutdown = server.shutdown
+
+    results = []
+    for concurrency in args.concurrency:
+        run_id = f'c{concurrency}'
+        created = []
+
+        def put(session, i):
+            response = session.put(f'{base}/stops', params={'query': f'bench {run_id} {i}'})
+            if response.status_code == 201:
+                created.extend(stop['stop_id'] for stop in response.json())
+            return response.status_code == 201
+
+        def get(session, i):
+            return session.get(f'{base}/stops/{random.choice(created)}').status_code == 200
+
+        def patch(session, i):
+            response = session.patch(f'{base}/stops/{random.choice(created)}', json={'name': f'Renamed {i}'})
+            return response.status_code == 200
+
+        def departures(session, i):
+            return session.get(f'{base}/stops/{random.choice(created)}/departures').status_code == 200
+
+        def delete(session, i):
+            return session.delete(f'{base}/stops/{created.pop()}').status_code == 200
+
+        calls = {'put': put, 'get': get, 'patch': patch, 'departures': departures, 'delete': delete}
+        for operation in OPERATIONS:
+            if operation not in args.operations:
+                continue
+            count = min(args.requests, len(created)) if operation == 'delete' else args.requests
+            if operation != 'put' and not created:
+                continue
+            # the app prints every payload, keep that out of the report
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                result = run_load(calls[operation], count, concurrency)
+            result.update({'operation': operation, 'concurrency': concurrency})
+            results.append(result)
+            print(f"{operation:>10}  c={concurrency:<4} {result['throughput']:>9.1f} req/s  "
+                  f"p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  p99 {result['p99_ms']:>8.2f}ms  "
+                  f"errors {result['errors']}")
+
+    shutdown()
+    stub.stop()
+    return {
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'settings': {
+            'serve': args.serve,
+            'requests': args.requests,
+            'upstream_latency_ms': args.upstream_latency,
+            'gemini_latency_ms': args.gemini_latency,
+            'departures': args.departures,
+        },
+        'upstream_requests': stub.requests,
+        'gemini_calls': fake_gemini.calls,
+        'results': results,
+    }
+
+
+# Serve the async mode's aiohttp app on its own event loop thread. Returns
+# the base URL and a function that stops it.
+def serve_async(async_app):
+    from aiohttp import web
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(async_app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def shutdown():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return f'http://127.0.0.1:{port}', shutdown
+
+
+# Print the change in throughput and p95 against an earlier results file
+def compare(current, previous):
+    before = {(result['operation'], result['concurrency']): result for result in previous['results']}
+    print(f"\ncompared with {previous.get('revision')} ({previous.get('date')})")
+    for result in current['results']:
+        old = before.get((result['operation'], result['concurrency']))
+        if old is None:
+            continue
+        throughput = (result['throughput'] - old['throughput']) / old['throughput'] * 100
+        p95 = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+        print(f"{result['operation']:>10}  c={result['concurrency']:<4} throughput {throughput:+7.1f}%  p95 {p95:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark for the API')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per operation and concurrency level')
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--upstream-latency', type=float, default=50, help='stub transport.rest latency in ms')
+    parser.add_argument('--gemini-latency', type=float, default=1000, help='fake Gemini latency in ms')
+    parser.add_argument('--departures', type=int, default=200, help='departures per stub payload')
+    parser.add_argument('--serve', choices=['threads', 'async'], default='threads',
+                        help='serve the app on Werkzeug threads or in the async mode')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    current = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f'\nsaved results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(current, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
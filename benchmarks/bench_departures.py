@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark for reading upstream departures payloads. Serves a large
+# recorded payload from the stand-in upstream and times finding the next
+# departure and the first five operators with the whole body parsed by
+# json.loads against the streaming parse that stops early. Each is timed on
+# cache misses, which fetch the body upstream first, and on cache hits, which
+# parse the stored body again. Peak memory per call is measured with
+# tracemalloc in a separate pass.
+#
+#   python benchmarks/bench_departures.py --departures 3000 --calls 200
+#   python benchmarks/bench_departures.py --fixture recorded_departures.json
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import closing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from stubs import StubUpstream, departures_payload
+
+CACHE_TTLS = (('miss', 0), ('hit', 3600))   # seconds; with no TTL every call goes upstream
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the streaming departures parse')
+    parser.add_argument('--departures', type=int, default=3000, help='departures in the generated payload')
+    parser.add_argument('--fixture', help='recorded departures payload to serve instead')
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.fixture:
+        with open(args.fixture, 'rb') as f:
+            body = f.read()
+    else:
+        body = json.dumps(departures_payload('8011160', args.departures)).encode()
+    stub = StubUpstream(latency=0, recorded=body).start()
+
+    import z5312750 as app_module
+    app_module.create_app({
+        'db_file': os.path.join(tempfile.mkdtemp(), 'bench_departures.db'),
+        'transport_base_url': stub.url,
+        'upstream_rate_per_minute': 1e9,
+        'upstream_burst': 1000000,
+        'debug_prints': False,
+    })
+
+    def whole(scan):
+        return lambda: scan(app_module.get_departures('8011160', 120))
+
+    def streamed(scan):
+        def call():
+            with closing(app_module.iter_departures('8011160', 120)) as departures:
+                return scan(departures)
+        return call
+
+    print(f'payload {len(body) / 1024:.0f} KiB, {args.calls} calls per case')
+    for view, ttl in CACHE_TTLS:
+        app_module.departures_cache = app_module.DeparturesCache(ttl, app_module.departures_cache_max_bytes)
+        for scan, find in (('next departure', app_module.find_next_departure), ('operators', app_module.find_operator_names)):
+            run_case(view, scan, 'json', whole(find), args.calls)
+            run_case(view, scan, 'stream', streamed(find), args.calls)
+
+    stub.stop()
+
+
+# Time `calls` calls, then measure the peak memory of one more
+def run_case(view, scan, mode, call, calls):
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'  {view:<5} {scan:<15} {mode:<7} p50 {percentile(timings, 0.50) * 1000:8.3f}ms'
+          f'  p95 {percentile(timings, 0.95) * 1000:8.3f}ms  peak {peak / 1024:9.1f} KiB')
+
+
+if __name__ == '__main__':
+    main()
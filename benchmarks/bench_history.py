@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark for the departures history. Seeds a scratch history database
+# with departures spread over the retention period and times the "average
+# delay at a stop per hour over the last week" query, and pruning a day.
+#
+#   python benchmarks/bench_history.py --rows 10000000 --stops 2000
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the departures history queries')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--stops', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=30, help='days of history to seed')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import z5312750 as app_module
+    scratch = tempfile.mkdtemp()
+    app_module.create_app({
+        'db_file': os.path.join(scratch, 'bench_history.db'),
+        'history_file': os.path.join(scratch, 'bench_history_departures.db'),
+        'history_enabled': True,
+        'history_retention_days': args.days + 1,
+    })
+
+    random.seed(args.seed)
+    conn = app_module.connect_to_history()
+    lines = [app_module.history_id(conn, 'lines', f'RE {i}') for i in range(50)]
+    directions = [app_module.history_id(conn, 'directions', f'Destination {i}') for i in range(100)]
+    operators = [app_module.history_id(conn, 'operators', f'Operator {i}') for i in range(10)]
+    conn.commit()
+
+    # Every stop gets the same number of departures, evenly spread in time
+    now = int(time.time())
+    start = now - args.days * 86400
+    per_stop = args.rows // args.stops
+    step = args.days * 86400 // per_stop
+    started = time.perf_counter()
+    batch = []
+    for stop_id in range(1, args.stops + 1):
+        for i in range(per_stop):
+            platform = str(random.randint(1, 12))
+            batch.append((stop_id, start + i * step + random.randint(0, step - 1), random.choice(lines),
+                          random.choice(directions), random.choice(operators), random.choice((0, 0, 60, 120, 300, None)),
+                          platform if random.random() < 0.95 else str(random.randint(1, 12)), platform, 0, now))
+        if len(batch) >= 200000:
+            with conn:
+                app_module.insert_history_rows(conn, batch)
+            batch = []
+    with conn:
+        app_module.insert_history_rows(conn, batch)
+    seeded = per_stop * args.stops
+    print(f'seeded {seeded} departures in {len(app_module.history_partition_names(conn))} partitions '
+          f'in {time.perf_counter() - started:.1f}s, {os.path.getsize(app_module.history_file) / seeded:.1f} bytes per departure')
+
+    for by in ('hour', 'hour_of_day'):
+        timings = []
+        for _ in range(args.queries):
+            stop_id = random.randint(1, args.stops)
+            started = time.perf_counter()
+            app_module.departure_delay_by_hour(stop_id, now - 7 * 86400, now, by)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f'last week by {by:<12} p50 {percentile(timings, 0.50) * 1000:.3f}ms  p95 {percentile(timings, 0.95) * 1000:.3f}ms')
+
+    # Pruning drops the oldest day as a whole table
+    app_module.history_retention_days = args.days - 1
+    started = time.perf_counter()
+    dropped = app_module.prune_history()
+    print(f'pruned {dropped} day partitions in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
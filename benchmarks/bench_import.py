@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark for the bulk import. Writes a GTFS stops.txt with random stops
+# spread over Germany to a scratch directory, imports it into an empty
+# database and reports the time taken. A second import into another empty
+# database measures the loader's peak Python memory with tracemalloc (RSS
+# would mostly show SQLite's page cache, which DB_CACHE_SIZE_KB bounds).
+#
+#   python benchmarks/bench_import.py --stops 500000
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+# Germany, roughly
+MIN_LAT, MAX_LAT = 47.3, 55.0
+MIN_LON, MAX_LON = 5.9, 15.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bulk stops import')
+    parser.add_argument('--stops', type=int, default=500000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import z5312750 as app_module
+    scratch = tempfile.mkdtemp()
+    app_module.create_app({'db_file': os.path.join(scratch, 'bench_import.db')})
+
+    random.seed(args.seed)
+    path = os.path.join(scratch, 'stops.txt')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'location_type', 'parent_station'])
+        for stop_id in range(1000000, 1000000 + args.stops):
+            writer.writerow([stop_id, '', f'Stop {stop_id} Hbf', round(random.uniform(MIN_LAT, MAX_LAT), 6),
+                             round(random.uniform(MIN_LON, MAX_LON), 6), 0, ''])
+    print(f'wrote {args.stops} stops, {os.path.getsize(path) / 1024 / 1024:.1f} MiB')
+
+    started = time.perf_counter()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        imported, skipped, errors = app_module.import_stops(f)
+    elapsed = time.perf_counter() - started
+    print(f'imported {imported} stops, skipped {skipped}, in {elapsed:.2f}s ({imported / elapsed:.0f} stops/s)')
+    for error in errors:
+        print('error:', error)
+
+    # The indexes were rebuilt: both searches see the imported stops
+    print('nearby finds', len(app_module.find_nearby_stops(52.5, 13.4, 5000, 10)),
+          'search finds', len(app_module.search_locations_db('Hbf', 5)))
+
+    app_module.create_app({'db_file': os.path.join(scratch, 'bench_import_memory.db')})
+    tracemalloc.start()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        app_module.import_stops(f)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'peak Python memory during the import {peak / 1024 / 1024:.1f} MiB '
+          f'(chunks of {app_module.import_chunk_size} rows)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark for the /stops/nearby search. Seeds a scratch database with
+# random stops spread over Germany and times find_nearby_stops against a
+# full table scan over the same data.
+#
+#   python benchmarks/bench_nearby.py --stops 100000 --queries 1000
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Germany, roughly
+MIN_LAT, MAX_LAT = 47.3, 55.0
+MIN_LON, MAX_LON = 5.9, 15.0
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the R*Tree nearby search')
+    parser.add_argument('--stops', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--radius', type=float, default=5000, help='search radius in metres')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Point the app at a scratch database
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import z5312750 as app_module
+    app_module.create_app({'db_file': os.path.join(tempfile.mkdtemp(), 'bench_nearby.db')})
+
+    random.seed(args.seed)
+    rows = [
+        (stop_id, f'Stop {stop_id}', random.uniform(MIN_LAT, MAX_LAT), random.uniform(MIN_LON, MAX_LON))
+        for stop_id in range(1, args.stops + 1)
+    ]
+    started = time.perf_counter()
+    app_module.upsert_locations(rows)
+    print(f'seeded {args.stops} stops in {time.perf_counter() - started:.2f}s')
+
+    points = [(random.uniform(MIN_LAT, MAX_LAT), random.uniform(MIN_LON, MAX_LON)) for _ in range(args.queries)]
+
+    # Indexed search
+    timings = []
+    for latitude, longitude in points:
+        started = time.perf_counter()
+        app_module.find_nearby_stops(latitude, longitude, args.radius, args.limit)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+
+    # Full table scan over the same points, for comparison
+    conn = app_module.connect_to_database()
+    scan_timings = []
+    for latitude, longitude in points[:min(args.queries, 50)]:
+        started = time.perf_counter()
+        stops = []
+        for stop_id, stop_latitude, stop_longitude in conn.execute('SELECT location_id, latitude, longitude FROM locations'):
+            distance = app_module.distance_metres(latitude, longitude, stop_latitude, stop_longitude)
+            if distance <= args.radius:
+                stops.append((distance, stop_id))
+        stops.sort()
+        scan_timings.append(time.perf_counter() - started)
+    scan_timings.sort()
+
+    print(f'nearby search, {args.queries} queries, radius {args.radius:.0f}m, limit {args.limit}')
+    print(f'  r*tree  p50 {percentile(timings, 0.50) * 1000:.3f}ms  p95 {percentile(timings, 0.95) * 1000:.3f}ms'
+          f'  p99 {percentile(timings, 0.99) * 1000:.3f}ms')
+    print(f'  scan    p50 {percentile(scan_timings, 0.50) * 1000:.3f}ms  p95 {percentile(scan_timings, 0.95) * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
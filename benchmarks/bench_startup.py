@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures how long a fresh worker takes to import the app and to build it
+# with create_app(), and checks both against a budget. Every run is a new
+# interpreter so nothing is already imported or cached.
+#
+#   python benchmarks/bench_startup.py --runs 10
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# Budgets in seconds for the median run. Importing is mostly Flask and
+# flask_restx; create_app() only creates the tables on a new database file.
+IMPORT_BUDGET = 0.5
+STARTUP_BUDGET = 0.1
+
+# Runs in the child interpreter and prints its timings as JSON
+CHILD = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import z5312750
+imported = time.perf_counter()
+z5312750.create_app({{'db_file': {db_file!r}}})
+ready = time.perf_counter()
+print(json.dumps({{'import': imported - started, 'startup': ready - imported,
+                  'gemini_loaded': 'google.generativeai' in sys.modules}}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import and create_app() time')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET)
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    root = str(Path(__file__).resolve().parent.parent)
+    scratch = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.pop('GOOGLE_API_KEY', None)     # the app must start without it
+
+    results = []
+    for run in range(args.runs):
+        db_file = os.path.join(scratch, f'bench_startup_{run}.db')
+        output = subprocess.run([sys.executable, '-c', CHILD.format(root=root, db_file=db_file)],
+                                env=env, cwd=scratch, capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    import_time = statistics.median(result['import'] for result in results)
+    startup_time = statistics.median(result['startup'] for result in results)
+    print(f'{args.runs} runs, median import {import_time * 1000:.1f}ms (budget {args.import_budget * 1000:.0f}ms), '
+          f'median create_app {startup_time * 1000:.1f}ms (budget {args.startup_budget * 1000:.0f}ms)')
+
+    failures = []
+    if import_time > args.import_budget:
+        failures.append('import is over budget')
+    if startup_time > args.startup_budget:
+        failures.append('create_app is over budget')
+    if any(result['gemini_loaded'] for result in results):
+        failures.append('google.generativeai was imported during startup')
+    for failure in failures:
+        print('FAIL:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
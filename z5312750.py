@@ -6,173 +6,1162 @@
 # (which you will, e.g. sqlite3).
 import os
 from pathlib import Path
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, has_request_context
+import click
 import sqlite3 as sql
 from flask_restx import Api, Resource, Namespace, fields, reqparse
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 import json
+import csv
+import io
 import re
+import time
+import random
+import threading
+import heapq
+import itertools
+import math
+import hashlib
+import codecs
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from contextlib import contextmanager, closing
 from dotenv import load_dotenv          
-import google.generativeai as genai 
 
-app = Flask(__name__)
-api = Api(app, title=' Deutsche Bahn API',
+# The Flask app is built by create_app(), the resources below are attached to it there
+api = Api(title=' Deutsche Bahn API',
           description='A simple API to query information about Deutsche Bahn trains. Sophia Cibei z5312750')
 
 studentid = Path(__file__).stem         # Will capture your zID from the filename.
-db_file   = f"{studentid}.db"           # Use this variable when referencing the SQLite database file.
+db_file   = os.environ.get("DB_FILE", f"{studentid}.db")   # Use this variable when referencing the SQLite database file.
 txt_file  = f"{studentid}.txt"          # Use this variable when referencing the txt file for Q7.
 
 # Load the environment variables from the .env file
 load_dotenv()
 
-# Configure the API key
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+# Settings for Gemini. The client is only created on the first call that needs
+# it, so starting the app does not import google.generativeai or need the key.
+google_api_key    = os.environ.get("GOOGLE_API_KEY")
+gemini_model_name = os.environ.get("GEMINI_MODEL", "gemini-pro")
+
+# Set DEBUG_PRINTS=0 to stop printing request payloads and other per-request chatter
+debug_prints = os.environ.get("DEBUG_PRINTS", "1") == "1"
+
+def debug_print(*args):
+    if debug_prints:
+        print(*args)
+
+
+# Latency histogram buckets in seconds, shared by every endpoint
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Process-wide counters and per-endpoint latency histograms for /metrics.
+# Recording is a dict update under a lock, cheap enough to leave on.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # (method, endpoint) -> [bucket counts, sum, count]
+        self.responses = {}     # (method, endpoint, status) -> count
+        self.counters = {}      # name -> value
+        self.db_seconds = 0.0
+        self.db_statements = 0
+
+    def observe_request(self, method, endpoint, status, elapsed):
+        with self.lock:
+            histogram = self.histograms.get((method, endpoint))
+            if histogram is None:
+                histogram = self.histograms[(method, endpoint)] = [[0] * len(latency_buckets), 0.0, 0]
+            for i, bound in enumerate(latency_buckets):
+                if elapsed <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += elapsed
+            histogram[2] += 1
+            key = (method, endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def add_db_time(self, elapsed):
+        with self.lock:
+            self.db_seconds += elapsed
+            self.db_statements += 1
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+# Add the time spent in a phase ('upstream', 'db', 'gemini', ...) to the
+# current request's Server-Timing header
+def record_phase(phase, elapsed):
+    if phase == 'db':
+        metrics.add_db_time(elapsed)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[phase] = timings.get(phase, 0) + elapsed
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - started)
+
+# Settings for the upstream transport.rest client (can be overridden in the .env file)
+transport_base_url       = os.environ.get("TRANSPORT_BASE_URL", "https://v6.db.transport.rest")
+upstream_connect_timeout = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+upstream_read_timeout    = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+upstream_max_retries     = int(os.environ.get("UPSTREAM_MAX_RETRIES", 2))
+upstream_backoff         = float(os.environ.get("UPSTREAM_BACKOFF", 0.25))
+upstream_pool_size       = int(os.environ.get("UPSTREAM_POOL_SIZE", 10))
+upstream_lookup_workers  = int(os.environ.get("UPSTREAM_LOOKUP_WORKERS", 4))   # concurrent /locations calls per PUT
+
+# transport.rest allows about 100 requests a minute. With a bucket of
+# `burst` tokens refilled at `rate` per minute we never send more than
+# burst + rate requests in any minute, so the defaults stay under it.
+upstream_rate_per_minute = float(os.environ.get("UPSTREAM_RATE_PER_MINUTE", 90))
+upstream_burst           = int(os.environ.get("UPSTREAM_BURST", 10))
+upstream_queue_timeout   = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", 10))             # seconds, interactive
+upstream_background_queue_timeout = float(os.environ.get("UPSTREAM_BACKGROUND_QUEUE_TIMEOUT", 60))
+
+# Priorities for the rate limiter queue, lower goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND  = 1
+
+
+# Raised when a request waited in the rate limiter queue past its deadline
+class RateLimitExceeded(requests.RequestException):
+    pass
+
+
+# Token bucket shared by every upstream call. Callers that find the bucket
+# empty queue up, highest priority and then oldest first, until a token is
+# refilled or their deadline passes.
+class RateLimiter:
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0      # tokens per second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = []                       # heap of (priority, ticket number)
+        self.tickets = itertools.count()
+        self.throttled = 0
+        self.expired = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    first = self.waiting[0] == ticket
+                    if first and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.expired += 1
+                        raise RateLimitExceeded('timed out waiting for the upstream rate limit')
+                    if first:
+                        self.throttled += 1
+                        remaining = min(remaining, (1 - self.tokens) / self.rate)
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+
+    # acquire() for the event loop: waits with asyncio.sleep() in the same
+    # queue, polling instead of being notified
+    async def acquire_async(self, priority, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+        try:
+            while True:
+                with self.cond:
+                    self._refill()
+                    first = self.waiting[0] == ticket
+                    if first and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.expired += 1
+                        raise RateLimitExceeded('timed out waiting for the upstream rate limit')
+                    if first:
+                        self.throttled += 1
+                        remaining = min(remaining, (1 - self.tokens) / self.rate)
+                await asyncio.sleep(min(remaining, async_limiter_poll))
+        finally:
+            with self.cond:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            self._refill()
+            return {
+                'tokens': round(self.tokens, 2),
+                'capacity': self.capacity,
+                'queue_depth': len(self.waiting),
+                'queued_interactive': sum(1 for ticket in self.waiting if ticket[0] == PRIORITY_INTERACTIVE),
+                'queued_background': sum(1 for ticket in self.waiting if ticket[0] != PRIORITY_INTERACTIVE),
+                'throttled': self.throttled,
+                'expired': self.expired,
+            }
+
+
+# Shared HTTP client for every call to v6.db.transport.rest. The session keeps
+# connections alive and pools them per host, so we only pay the TCP+TLS
+# handshake once per pooled connection instead of once per request.
+class UpstreamClient:
+    def __init__(self, base_url, connect_timeout, read_timeout, max_retries, backoff, pool_size, limiter):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        # retries are done by hand in get() so we can add jitter to the backoff
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.status_counts = {}     # upstream status code, or 'error', -> count
+
+    def count_status(self, status):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    # GET a path on the upstream API, retrying 5xx responses and connection
+    # errors. Every attempt waits for a rate limiter token first.
+    # Raises RateLimitExceeded if no token came in time, or another
+    # requests.RequestException if every attempt fails.
+    def get(self, path, params=None, priority=PRIORITY_INTERACTIVE):
+        # in the async mode, fail the same way the prefetch on the event loop did
+        if has_request_context() and 'prefetch.error' in request.environ:
+            raise request.environ['prefetch.error']
+        url = f"{self.base_url}{path}"
+        queue_timeout = upstream_queue_timeout if priority == PRIORITY_INTERACTIVE else upstream_background_queue_timeout
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            with timed('ratelimit'):
+                self.limiter.acquire(priority, queue_timeout)
+            try:
+                with timed('upstream'):
+                    response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                print('upstream request failed:', url, e)
+                self.count_status('error')
+                if last_attempt:
+                    raise
+            else:
+                self.count_status(response.status_code)
+                if response.status_code < 500 or last_attempt:
+                    return response
+                print('upstream returned', response.status_code, url)
+                response.close()
+
+            # exponential backoff with full jitter before the next attempt
+            with self.lock:
+                self.retries += 1
+            time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    # Counters for the connection pools. 'reused' is how many requests went
+    # out on an already open connection instead of a new handshake.
+    def stats(self):
+        requests_sent = 0
+        connections_opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+        return {
+            'requests': requests_sent,
+            'connections_opened': connections_opened,
+            'reused': requests_sent - connections_opened,
+            'retries': self.retries,
+            'status_counts': dict(self.status_counts),
+        }
+
+
+
+# Coalesces identical concurrent calls: the first caller for a key runs the
+# call and everyone else who asks for the same key while it is running waits
+# for it and gets the same result, or the same exception.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}     # key -> [done event, result, exception]
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None, None]
+                self.in_flight[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fn(*args)
+            return call[1]
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call[0].set()
+
+    # Count a caller that joined an identical call tracked somewhere else
+    def record_coalesced(self):
+        with self.lock:
+            self.coalesced += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.in_flight),
+            }
+
+
+
+# Settings for the departures cache (can be overridden in the .env file)
+departures_window          = 120    # minutes fetched upstream, every shorter view is sliced from it
+departures_cache_ttl       = float(os.environ.get("DEPARTURES_CACHE_TTL", 30))
+departures_cache_max_bytes = int(os.environ.get("DEPARTURES_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+departures_streaming       = os.environ.get("DEPARTURES_STREAMING", "1") == "1"   # parse departures lazily
+stream_chunk_size          = 64 * 1024     # bytes of a departures body decoded at a time
+
+
+# In-process LRU cache of upstream departures, keyed by stop_id. Each entry
+# holds the full departures_window so /stops/<id> (120 minutes) and
+# /stops/<id>/departures (90 minutes) share one upstream call. Entries keep
+# the raw upstream body, which is parsed again on every hit: parsed, the same
+# departures take six to seven times the memory. max_bytes bounds the bodies
+# held, and least recently used entries are evicted once it is exceeded.
+class DeparturesCache:
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # stop_id -> (expires_at, fetched_at, body)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, stop_id):
+        with self.lock:
+            entry = self.entries.get(stop_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(stop_id)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(stop_id)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, stop_id, fetched_at, body):
+        with self.lock:
+            if stop_id in self.entries:
+                self._remove(stop_id)
+            if len(body) > self.max_bytes:
+                return
+            self.entries[stop_id] = (time.monotonic() + self.ttl, fetched_at, body)
+            self.total_bytes += len(body)
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    # Drop a stop's entry if it still holds `body`, e.g. once it failed to parse
+    def discard(self, stop_id, body):
+        with self.lock:
+            entry = self.entries.get(stop_id)
+            if entry is not None and entry[2] is body:
+                self._remove(stop_id)
+
+    def _remove(self, stop_id):
+        entry = self.entries.pop(stop_id)
+        self.total_bytes -= len(entry[2])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def fetch_locations(query, priority):
+    response = upstream.get('/locations', params={'query': query, 'results': 5}, priority=priority)
+    debug_print('this is the reqponse', response)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'upstream returned {response.status_code}', response=response)
+    return response.json()
+
+# Look up the stops matching one query string, sharing the call with any
+# identical lookup already in flight at the same priority, so an interactive
+# lookup never waits out a background one's place in the upstream queue.
+# Raises requests.RequestException if the upstream call fails.
+def lookup_locations(query, priority=PRIORITY_INTERACTIVE):
+    return upstream_flight.do(('locations', query, priority), fetch_locations, query, priority)
+
+# Look up several queries concurrently and merge the results, keeping one
+# entry per stop id. A bulk lookup is background work for the rate limiter.
+# `prefetched` maps queries the async mode already looked up to their
+# results, or to the exception the lookup raised.
+# Raises requests.RequestException if any lookup fails.
+def lookup_many_locations(queries, prefetched=None):
+    if prefetched is not None:
+        results = [prefetched[query] for query in queries]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    elif len(queries) == 1:
+        results = [lookup_locations(queries[0])]
+    else:
+        results = lookup_executor.map(lambda query: lookup_locations(query, PRIORITY_BACKGROUND), queries)
+    stops = {}
+    for stop_data in results:
+        for item in stop_data:
+            stops[item['id']] = item
+    return list(stops.values())
+
+
+# Return when a departure leaves, falling back to the planned time for
+# cancelled trips that have no realtime 'when'
+def departure_time(entry):
+    value = entry.get('when') or entry.get('plannedWhen')
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+# Fetch the whole departures_window for a stop and store its body in the
+# cache. The body is only parsed when the history needs every departure:
+# readers parse it lazily, and drop it from the cache if it turns out bad.
+def fetch_departures_window(stop_id, priority):
+    fetched_at = datetime.now(timezone.utc)
+    response = upstream.get(f'/stops/{stop_id}/departures', params={'duration': departures_window}, priority=priority)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'upstream returned {response.status_code}', response=response)
+    if history_enabled:
+        record_departures(stop_id, fetched_at, parse_departures(response.content))
+    departures_cache.put(stop_id, fetched_at, response.content)
+    return fetched_at, response.content
+
+# Get the departures_window for a stop as (fetched_at, body), from the cache
+# or, on a miss, from one upstream call shared with any concurrent misses
+# for the same stop at the same priority.
+# Raises requests.RequestException if the upstream call fails.
+def get_departures_window(stop_id, priority=PRIORITY_INTERACTIVE):
+    cached = prefetched_departures(stop_id) or departures_cache.get(stop_id)
+    if cached is None:
+        cached = upstream_flight.do(('departures', stop_id, priority), fetch_departures_window, stop_id, priority)
+    return cached
+
+# Parse all the departures in a departures body
+def parse_departures(body):
+    try:
+        return json.loads(body)['departures']
+    except (ValueError, KeyError, TypeError) as e:
+        raise requests.exceptions.InvalidJSONError(f'bad departures payload: {e}')
+
+# Get the departures for a stop over the next `duration` minutes. The cached
+# departures_window is sliced on 'when', so only a cache miss goes upstream.
+# Raises requests.RequestException if the upstream call fails.
+def get_departures(stop_id, duration, priority=PRIORITY_INTERACTIVE):
+    if duration > departures_window:
+        fetched_at = datetime.now(timezone.utc)
+        response = upstream.get(f'/stops/{stop_id}/departures', params={'duration': duration}, priority=priority)
+        if response.status_code != 200:
+            raise requests.HTTPError(f'upstream returned {response.status_code}', response=response)
+        departures = response.json()['departures']
+        record_departures(stop_id, fetched_at, departures)
+        return departures
 
-# Create a Gemini Pro model
-gemini = genai.GenerativeModel('gemini-pro')
+    fetched_at, body = get_departures_window(stop_id, priority)
+    try:
+        departures = parse_departures(body)
+    except requests.exceptions.InvalidJSONError:
+        departures_cache.discard(stop_id, body)
+        raise
+    return list(slice_departures(fetched_at, departures, duration))
+
+# The departures_window the async mode fetched for this request, if it did
+def prefetched_departures(stop_id):
+    if has_request_context():
+        return request.environ.get('prefetch.departures', {}).get(stop_id)
+    return None
+
+# Yield the departures from a cached window that leave within `duration` minutes
+def slice_departures(fetched_at, departures, duration):
+    if duration == departures_window:
+        yield from departures
+        return
+    window_end = fetched_at + timedelta(minutes=duration)
+    for entry in departures:
+        when = departure_time(entry)
+        if when is None or when <= window_end:
+            yield entry
+
+# Describe the first departure that has both a platform and a direction,
+# e.g. "Platform 3 towards Berlin Hbf". Returns None if there is none.
+def find_next_departure(departures):
+    for entry in departures:
+        if entry.get('platform') is not None and entry.get('direction') is not None:
+            return f"Platform {entry['platform']} towards {entry['direction']}"
+    return None
+
+# Return the names of the first `limit` operators running from a stop, in
+# order of departure
+def find_operator_names(departures, limit=5):
+    operator_names = []
+    for result in departures:
+        if 'line' in result and 'operator' in result['line']:
+            if result['line']['operator']['name'] not in operator_names:
+                operator_names.append(result['line']['operator']['name'])
+
+        if len(operator_names) == limit:
+            break
+    return operator_names
+
+
+json_decoder = json.JSONDecoder()
+
+# Reads JSON values one at a time from a body that arrives in chunks. Only
+# the unparsed tail of the body is kept in the buffer.
+class JsonStreamReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+
+    # Append the next chunk to the buffer. Returns False at the end of the body.
+    def fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
 
+    # Return the next character that isn't whitespace without consuming it,
+    # or '' at the end of the body
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    # Consume the next character, which has to be one of `chars`
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f'expected one of {chars!r} in JSON body, got {char!r}')
+        self.pos += 1
+        return char
+
+    # Parse the next whole value, reading more of the body until it is complete
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # a number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+# Yield the items of the array under `key` in a JSON object, parsing them one
+# at a time as the chunks arrive instead of loading the whole body. Other
+# keys before it are parsed and skipped.
+def iter_json_array(chunks, key):
+    reader = JsonStreamReader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name != key:
+            reader.value()
+        else:
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    return
+        if reader.expect(',}') == '}':
+            return
+
+# Yield the departures in a departures body, parsing them one at a time
+# Raises requests.RequestException if the body isn't a departures payload.
+def iter_departures_body(body):
+    chunks = (body[start:start + stream_chunk_size] for start in range(0, len(body), stream_chunk_size))
+    try:
+        yield from iter_json_array(chunks, 'departures')
+    except ValueError as e:
+        raise requests.exceptions.InvalidJSONError(f'bad departures payload: {e}')
+
+# Iterate over the departures for a stop over the next `duration` minutes.
+# The departures_window body, cached or just fetched as in get_departures(),
+# is parsed one departure at a time, so a caller that stops early never
+# parses the rest. Longer views aren't cached and are parsed whole. Close the
+# generator when done with it.
+# Raises requests.RequestException if the upstream call fails, also while
+# iterating.
+def iter_departures(stop_id, duration, priority=PRIORITY_INTERACTIVE):
+    if not departures_streaming or duration > departures_window:
+        yield from get_departures(stop_id, duration, priority)
+        return
+    fetched_at, body = get_departures_window(stop_id, priority)
+    try:
+        yield from slice_departures(fetched_at, iter_departures_body(body), duration)
+    except requests.exceptions.InvalidJSONError:
+        departures_cache.discard(stop_id, body)
+        raise
+
+
+# Settings for the SQLite connections (can be overridden in the .env file)
+db_busy_timeout = float(os.environ.get("DB_BUSY_TIMEOUT", 5))                 # seconds
+db_cache_size   = int(os.environ.get("DB_CACHE_SIZE_KB", 64 * 1024))          # page cache per connection
+db_mmap_size    = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))      # bytes
+
+# Cursor and connection that add the time spent in SQLite to the 'db' phase
+class TimedCursor(sql.Cursor):
+    def execute(self, *args):
+        with timed('db'):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with timed('db'):
+            return super().executemany(*args)
+
+    def fetchone(self):
+        with timed('db'):
+            return super().fetchone()
+
+    def fetchall(self):
+        with timed('db'):
+            return super().fetchall()
+
+class TimedConnection(sql.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def __exit__(self, *args):
+        with timed('db'):
+            return super().__exit__(*args)
+
+# Open a connection with the tuned pragmas. WAL lets readers carry on while
+# another connection is writing, and synchronous=NORMAL is safe with WAL.
+def open_connection(path=None):
+    conn = sql.connect(path or db_file, timeout=db_busy_timeout, factory=TimedConnection)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{db_cache_size}")
+    conn.execute(f"PRAGMA mmap_size = {db_mmap_size}")
+    conn.execute(f"PRAGMA busy_timeout = {int(db_busy_timeout * 1000)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+# Function to connect to the SQLite database. Returns this thread's
+# connection, which stays open, so callers must not close it.
+def connect_to_database():
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        conn = open_connection()
+        db_local.conn = conn
+    return conn
+
+# Columns added to locations after the table was first released
+locations_added_columns = {
+    'next_departure_refreshed_at': 'REAL',      # unix time next_departure was last fetched
+    'modified_at': 'REAL',                      # unix time anything in the stop's representation last changed
+    'next_departure_attempted_at': 'REAL',      # unix time next_departure was last looked for, found or not
+}
+
+# SQL for the current unix time, as modified_at stores it
+unix_now_sql = "(julianday('now') - 2440587.5) * 86400.0"
+
+# Triggers that keep locations_rtree and locations_fts in step with locations.
+# The insert and update ones can be dropped for a bulk load and recreated
+# after rebuild_location_indexes().
+index_load_triggers = ('locations_rtree_insert', 'locations_rtree_update', 'locations_fts_insert', 'locations_fts_update')
+
+def create_index_triggers(cursor):
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_insert AFTER INSERT ON locations
+                      WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+                      BEGIN
+                          INSERT OR REPLACE INTO locations_rtree
+                          VALUES (NEW.location_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_update AFTER UPDATE OF location_id, latitude, longitude ON locations
+                      BEGIN
+                          DELETE FROM locations_rtree WHERE location_id = OLD.location_id;
+                          INSERT INTO locations_rtree
+                          SELECT NEW.location_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+                          WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_rtree_delete AFTER DELETE ON locations
+                      BEGIN
+                          DELETE FROM locations_rtree WHERE location_id = OLD.location_id;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_fts_insert AFTER INSERT ON locations
+                      BEGIN
+                          INSERT INTO locations_fts (rowid, name) VALUES (NEW.location_id, NEW.name);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_fts_update AFTER UPDATE OF location_id, name ON locations
+                      BEGIN
+                          INSERT INTO locations_fts (locations_fts, rowid, name) VALUES ('delete', OLD.location_id, OLD.name);
+                          INSERT INTO locations_fts (rowid, name) VALUES (NEW.location_id, NEW.name);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS locations_fts_delete AFTER DELETE ON locations
+                      BEGIN
+                          INSERT INTO locations_fts (locations_fts, rowid, name) VALUES ('delete', OLD.location_id, OLD.name);
+                      END''')
+
+def drop_index_load_triggers(cursor):
+    for trigger in index_load_triggers:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+# Refill locations_rtree and locations_fts from locations in one pass each
+def rebuild_location_indexes(cursor):
+    cursor.execute("DELETE FROM locations_rtree")
+    cursor.execute('''INSERT INTO locations_rtree
+                      SELECT location_id, latitude, latitude, longitude, longitude FROM locations
+                      WHERE latitude IS NOT NULL AND longitude IS NOT NULL''')
+    cursor.execute("INSERT INTO locations_fts (locations_fts) VALUES ('rebuild')")
 
 # Function to create SQLite database and table
 def create_database():
-    conn = sql.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS locations
-                      (location_id INTEGER PRIMARY KEY,
-                       name TEXT,
-                       latitude REAL, 
-                       longitude REAL, 
-                       next_departure TEXT, 
-                       last_updated TEXT,
-                       link_self_href TEXT,
-                       UNIQUE(location_id))''')
-    conn.commit()
-    conn.close()
-
-# Check if the database file already exists
-if not os.path.exists(db_file):
-    create_database()
-
-# Function to connect to the SQLite database
-def connect_to_database():
-    return sql.connect(db_file)
+    conn = connect_to_database()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS locations
+                          (location_id INTEGER PRIMARY KEY,
+                           name TEXT,
+                           latitude REAL, 
+                           longitude REAL, 
+                           next_departure TEXT, 
+                           last_updated TEXT,
+                           link_self_href TEXT,
+                           next_departure_refreshed_at REAL,
+                           modified_at REAL,
+                           next_departure_attempted_at REAL,
+                           UNIQUE(location_id))''')
+        # Add the columns that older databases were created without
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(locations)")}
+        for column, column_type in locations_added_columns.items():
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE locations ADD COLUMN {column} {column_type}")
+        # stops stored before modified_at existed count as changed now
+        if 'modified_at' not in existing_columns:
+            cursor.execute(f"UPDATE locations SET modified_at = {unix_now_sql}")
+        if 'next_departure_attempted_at' not in existing_columns:
+            cursor.execute("UPDATE locations SET next_departure_attempted_at = next_departure_refreshed_at")
+        # Deleting a stop changes its neighbours' prev/next links and the
+        # listing pages it was on, so the time of the last delete is kept
+        cursor.execute('''CREATE TABLE IF NOT EXISTS locations_changes
+                          (change TEXT PRIMARY KEY,
+                           changed_at REAL)''')
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS locations_record_delete AFTER DELETE ON locations
+                           BEGIN
+                               INSERT OR REPLACE INTO locations_changes VALUES ('delete', {unix_now_sql});
+                           END''')
+        # lets the refresher find the stops tried longest ago without reading them all
+        cursor.execute("DROP INDEX IF EXISTS locations_refreshed_at")
+        cursor.execute("CREATE INDEX IF NOT EXISTS locations_attempted_at ON locations (next_departure_attempted_at)")
+        # R*Tree over the stop coordinates for /stops/nearby, and an FTS5
+        # index over the stop names for the local search (an external content
+        # table on locations). Triggers keep both in sync with locations so
+        # every insert, upsert, PATCH and delete is covered.
+        rtree_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'locations_rtree'").fetchone()
+        triggers = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree
+                          USING rtree(location_id, min_lat, max_lat, min_lon, max_lon)''')
+        fts_exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'locations_fts'").fetchone()
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS locations_fts
+                          USING fts5(name, content='locations', content_rowid='location_id',
+                                     tokenize='unicode61 remove_diacritics 2')''')
+        create_index_triggers(cursor)
+        # A new index starts empty, and a bulk import that died before
+        # putting its triggers back left out every row it had loaded
+        if not fts_exists or not rtree_exists or not triggers.issuperset(index_load_triggers):
+            rebuild_location_indexes(cursor)
+        cursor.execute('''CREATE TABLE IF NOT EXISTS operator_profiles
+                          (operator_name TEXT PRIMARY KEY,
+                           information TEXT,
+                           generated_at REAL)''')
 
 def check_in_db(table_name, id_to_check):
-    # Connect to the database
-    conn = sql.connect(db_file)
+    conn = connect_to_database()
     cursor = conn.cursor()
 
     # Execute the query to check the existence of the ID
     cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE location_id = ?", (id_to_check,))
     result = cursor.fetchone()[0]
 
-    # Close the database connection
-    conn.close()
-
     # Return True if the ID exists, False otherwise
     return result > 0
 
-# Update the next_departure field for a specific location ID
-def update_next_departure(location_id, new_next_departure):
-    conn = sql.connect(db_file)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE locations SET next_departure = ? WHERE location_id = ?", (new_next_departure, location_id))
-        conn.commit()
-        print("Next departure updated successfully.")
-    except sql.Error as e:
-        print("Error updating next departure:", e)
-    
-    conn.close()
-
+# Columns for a stop row followed by the ids of the stops before and after it,
+# used for the prev/next links, then when its next_departure was refreshed
+# and when anything in its representation last changed: the stop itself, a
+# neighbour (a new stop becomes one), or a delete that moved a link. The
+# neighbour lookups are searches on the primary key, so they stay O(log n)
+# where a LAG/LEAD window over the table would have to scan every row.
+stop_info_columns = """
+    location_id, 
+    last_updated, 
+    name, 
+    latitude, 
+    longitude, 
+    next_departure,
+    (SELECT MAX(prev.location_id) FROM locations AS prev WHERE prev.location_id < locations.location_id),
+    (SELECT MIN(next.location_id) FROM locations AS next WHERE next.location_id > locations.location_id),
+    next_departure_refreshed_at,
+    MAX(COALESCE(modified_at, 0),
+        COALESCE((SELECT prev.modified_at FROM locations AS prev WHERE prev.location_id < locations.location_id
+                  ORDER BY prev.location_id DESC LIMIT 1), 0),
+        COALESCE((SELECT next.modified_at FROM locations AS next WHERE next.location_id > locations.location_id
+                  ORDER BY next.location_id LIMIT 1), 0),
+        COALESCE((SELECT changed_at FROM locations_changes WHERE change = 'delete'), 0))
+"""
+
+# Read a stop with its neighbours, or None if it is not in the database
 def get_stop_info_db(location_id):
-    conn = sql.connect(db_file)
+    conn = connect_to_database()
     cursor = conn.cursor()
+    result = None
     try:
-        cursor.execute("""
-            SELECT 
-                location_id, 
-                last_updated, 
-                name, 
-                latitude, 
-                longitude, 
-                next_departure
-            FROM 
-                locations
-            WHERE 
-                location_id = ?
-        """, (location_id,))
-        # Fetch the result
+        cursor.execute(f"SELECT {stop_info_columns} FROM locations WHERE location_id = ?", (location_id,))
         result = cursor.fetchone()
     except sql.Error as e:
-        print("Error updating next departure:", e)
-
-    conn.close()
+        print("Error reading stop:", e)
     return result
 
-def get_prev_next(location_id):
-    conn = sql.connect(db_file)
-    cursor = conn.cursor()
+# Update the next_departure field for a specific location ID and return the
+# updated row with its neighbours, in one statement and one transaction.
+# Returns None if the stop is not in the database.
+def update_next_departure(location_id, new_next_departure):
+    conn = connect_to_database()
+    result = None
     try:
-        # Get the row above the provided location ID
-        cursor.execute("""
-            SELECT 
-                location_id
-            FROM 
-                locations
-            WHERE 
-                location_id < ?
-            ORDER BY 
-                location_id DESC
-            LIMIT 1
-        """, (location_id,))
-        row_above = cursor.fetchone()
-
-        # Get the row below the provided location ID
-        cursor.execute("""
-            SELECT 
-                location_id
-            FROM 
-                locations
-            WHERE 
-                location_id > ?
-            ORDER BY 
-                location_id ASC
-            LIMIT 1
-        """, (location_id,))
-        row_below = cursor.fetchone()
+        with conn:
+            cursor = conn.execute(f"UPDATE locations SET next_departure = ?1, next_departure_refreshed_at = ?2, \
+                                    next_departure_attempted_at = ?2, \
+                                    modified_at = CASE WHEN next_departure IS ?1 THEN modified_at ELSE {unix_now_sql} END \
+                                    WHERE location_id = ?3 RETURNING {stop_info_columns}",
+                                  (new_next_departure, time.time(), location_id))
+            rows = cursor.fetchall()
+        result = rows[0] if rows else None
+        debug_print("Next departure updated successfully.")
     except sql.Error as e:
         print("Error updating next departure:", e)
-    conn.close()
-    return row_above if row_above else None, row_below if row_below else None
+    return result
 
 def delete_record(table_name, record_id):
-    conn = sql.connect(db_file)
-    cursor = conn.cursor()
+    conn = connect_to_database()
+    success = False
 
     try:
-        # Check if the record exists
-        cursor.execute(f"SELECT * FROM {table_name} WHERE location_id = ?", (record_id,))
-        existing_record = cursor.fetchone()
-
-        if existing_record:
-            # If the record exists, delete it
-            cursor.execute(f"DELETE FROM {table_name} WHERE location_id = ?", (record_id,))
-            success = True
-        else:
-            success = False
-
-        # Commit the transaction and close the connection
-        conn.commit()
-        conn.close()
+        # The connection commits the transaction, or rolls it back on error
+        with conn:
+            cursor = conn.cursor()
+            # Check if the record exists
+            cursor.execute(f"SELECT * FROM {table_name} WHERE location_id = ?", (record_id,))
+            existing_record = cursor.fetchone()
+
+            if existing_record:
+                # If the record exists, delete it
+                cursor.execute(f"DELETE FROM {table_name} WHERE location_id = ?", (record_id,))
+                success = True
     except sql.Error as e:
         print("Error deleting record:", e)
-        conn.rollback()
-        conn.close()
     
     return success
 
+# Insert new stops and refresh the existing ones in a single transaction.
+# Each row is (location_id, name, latitude, longitude).
+def upsert_locations(rows):
+    conn = connect_to_database()
+    with conn:
+        conn.executemany(f"""
+            INSERT INTO locations (location_id, last_updated, name, latitude, longitude, link_self_href, modified_at)
+            VALUES (?1, datetime('now'), ?2, ?3, ?4, 'http://localhost:8888/stops/' || ?1, {unix_now_sql})
+            ON CONFLICT(location_id) DO UPDATE SET
+                last_updated = datetime('now'),
+                modified_at = excluded.modified_at,
+                name = excluded.name,
+                latitude = excluded.latitude,
+                longitude = excluded.longitude
+        """, rows)
+
+# Settings for the bulk import (can be overridden in the .env file)
+import_chunk_size = int(os.environ.get("IMPORT_CHUNK_SIZE", 50000))   # rows per transaction
+
+# Header names for the stop id, name, latitude and longitude in the files we
+# import: GTFS stops.txt, and the DB station list (semicolon separated, with
+# decimal commas)
+import_columns = {
+    'id': ('stop_id', 'eva_nr', 'id'),
+    'name': ('stop_name', 'name'),
+    'latitude': ('stop_lat', 'breite', 'latitude'),
+    'longitude': ('stop_lon', 'laenge', 'longitude'),
+}
+
+# Load the stops in a CSV file object into locations with upsert_locations(),
+# import_chunk_size rows per transaction, so memory stays flat however big the
+# file is. The R*Tree and FTS triggers are dropped for the load and both
+# indexes rebuilt in one pass at the end. Rows without valid coordinates are
+# skipped. So are rows whose id isn't a number, since only numeric ids (EVA
+# numbers) match the stops transport.rest returns. GTFS feeds that use IFOPT
+# ids such as de:11000:900003201 can't be imported, and the returned errors
+# say so. Returns (imported, skipped, errors).
+# Raises ValueError if the header lacks one of the import_columns.
+def import_stops(file):
+    header_line = file.readline()
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    header = [name.strip().lstrip('\ufeff').lower() for name in next(csv.reader([header_line], delimiter=delimiter))]
+    positions = []
+    for field, names in import_columns.items():
+        position = next((header.index(name) for name in names if name in header), None)
+        if position is None:
+            raise ValueError(f'no {field} column, expected one of {", ".join(names)}')
+        positions.append(position)
+    id_position, name_position, latitude_position, longitude_position = positions
+
+    conn = connect_to_database()
+    with import_lock:
+        with conn:
+            drop_index_load_triggers(conn.cursor())
+        imported = skipped = unnumbered = 0
+        first_unnumbered = None
+        try:
+            chunk = []
+            for record in csv.reader(file, delimiter=delimiter):
+                if len(record) <= max(positions):
+                    skipped += 1
+                    continue
+                try:
+                    location_id = int(record[id_position])
+                except ValueError:
+                    skipped += 1
+                    unnumbered += 1
+                    if first_unnumbered is None:
+                        first_unnumbered = record[id_position]
+                    continue
+                try:
+                    chunk.append((location_id, record[name_position],
+                                  float(record[latitude_position].replace(',', '.')),
+                                  float(record[longitude_position].replace(',', '.'))))
+                except ValueError:
+                    skipped += 1
+                    continue
+                if len(chunk) >= import_chunk_size:
+                    upsert_locations(chunk)
+                    imported += len(chunk)
+                    chunk = []
+            if chunk:
+                upsert_locations(chunk)
+                imported += len(chunk)
+        finally:
+            # rebuilt and switched back on together, so nothing written
+            # meanwhile is missed
+            with conn:
+                cursor = conn.cursor()
+                rebuild_location_indexes(cursor)
+                create_index_triggers(cursor)
+
+    errors = []
+    if unnumbered:
+        errors.append(f'{unnumbered} rows have a stop id that is not a number, e.g. {first_unnumbered!r}, '
+                      f'and were skipped: only numeric ids such as EVA numbers can be imported')
+    return imported, skipped, errors
+
+# Settings for the nearby search
+nearby_first_radius = 500           # metres searched first, widened until enough stops are found
+metres_per_degree   = 111320        # metres per degree of latitude
+
+# Great-circle distance in metres between two coordinates
+def distance_metres(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+# Find the `limit` stops closest to a point within `radius` metres, nearest
+# first, as (location_id, name, latitude, longitude, distance) rows.
+# Only the R*Tree boxes around the point are read: the search starts small
+# and widens until it holds enough stops, so dense areas stay cheap.
+def find_nearby_stops(latitude, longitude, radius, limit):
+    conn = connect_to_database()
+    search = min(radius, nearby_first_radius)
+    while True:
+        lat_delta = search / metres_per_degree
+        lon_delta = search / (metres_per_degree * max(math.cos(math.radians(latitude)), 0.01))
+        cursor = conn.execute("""
+            SELECT l.location_id, l.name, l.latitude, l.longitude
+            FROM locations_rtree AS r
+            JOIN locations AS l ON l.location_id = r.location_id
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+        """, (latitude - lat_delta, latitude + lat_delta, longitude - lon_delta, longitude + lon_delta))
+        stops = []
+        for location_id, name, stop_latitude, stop_longitude in cursor:
+            distance = distance_metres(latitude, longitude, stop_latitude, stop_longitude)
+            if distance <= search:
+                stops.append((location_id, name, stop_latitude, stop_longitude, distance))
+        # every stop closer than the ones found is inside the search circle,
+        # so once it holds `limit` stops those are the nearest overall
+        if len(stops) >= limit or search >= radius:
+            stops.sort(key=lambda stop: stop[4])
+            return stops[:limit]
+        search = min(search * 4, radius)
+
+# Read up to `limit` stops with a location_id after `after`, in id order.
+# Keyset pagination: each page is an index range search on the primary
+# key, however deep into the table it starts.
+def get_stops_page_db(after, limit):
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT location_id, last_updated, name, latitude, longitude, next_departure, modified_at
+        FROM locations
+        WHERE location_id > ?
+        ORDER BY location_id
+        LIMIT ?
+    """, (after, limit))
+    return cursor.fetchall()
+
+# Unix time a stop was last deleted, or 0 if none has been
+def get_last_delete_db():
+    conn = connect_to_database()
+    row = conn.execute("SELECT changed_at FROM locations_changes WHERE change = 'delete'").fetchone()
+    return row[0] if row else 0
+
+# Yield every stop after `after`, at most `limit` of them if given, reading
+# one page at a time so memory stays flat however many rows there are
+def iter_stops_db(after, limit=None, page_size=1000):
+    sent = 0
+    while limit is None or sent < limit:
+        size = page_size if limit is None else min(page_size, limit - sent)
+        rows = get_stops_page_db(after, size)
+        for row in rows:
+            yield row
+        sent += len(rows)
+        if len(rows) < size:
+            return
+        after = rows[-1][0]
+
+# Settings for the local stop search (can be overridden in the .env file)
+local_search_min_matches = int(os.environ.get("LOCAL_SEARCH_MIN_MATCHES", 3))
+local_search_max_age     = float(os.environ.get("LOCAL_SEARCH_MAX_AGE", 7 * 24 * 3600))    # seconds
+
+# Turn free text into an FTS5 query that matches stop names containing
+# every word, each as a prefix, so "berlin hb" finds "Berlin Hbf"
+def fts_query(text):
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Search the stored stop names, best match first, as
+# (location_id, name, latitude, longitude, last_updated) rows
+def search_locations_db(text, limit):
+    query = fts_query(text)
+    if not query:
+        return []
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT l.location_id, l.name, l.latitude, l.longitude, l.last_updated
+        FROM locations_fts AS f
+        JOIN locations AS l ON l.location_id = f.rowid
+        WHERE locations_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ?
+    """, (query, limit))
+    return cursor.fetchall()
+
+# Parse last_updated, which is written as "2024-03-10 12:00:00" in UTC by PUT
+# (SQLite's datetime('now')) and as "2024-03-10-12:00:00" in local time by
+# PATCH, or by the client without the middle dash. Returns an aware datetime,
+# or None if it is in none of the formats.
+def parse_last_updated(value):
+    for fmt, utc in (("%Y-%m-%d %H:%M:%S", True), ("%Y-%m-%d-%H:%M:%S", False), ("%Y-%m-%d%H:%M:%S", False)):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+        return parsed.replace(tzinfo=timezone.utc) if utc else parsed.astimezone()
+    return None
+
+# True if a stored stop was updated recently enough to answer a PUT locally
+def stop_is_fresh(last_updated):
+    parsed = parse_last_updated(last_updated)
+    return parsed is not None and (datetime.now(timezone.utc) - parsed).total_seconds() <= local_search_max_age
+
 def is_valid_datetime_format(value):
     # Define the regular expression pattern for the format "yyyy-mm-ddhh:mm:ss"
     pattern = r'^\d{4}-\d{2}-\d{2}\d{2}:\d{2}:\d{2}$'
@@ -183,114 +1172,851 @@ def is_valid_datetime_format(value):
     else:
         return False
 
-def update_field_in_db(table, field, value, condition_field, condition_value):
-    conn = sql.connect(db_file)
+# Columns of a stop that PATCH may change
+stop_patch_columns = ('last_updated', 'name', 'latitude', 'longitude', 'next_departure')
+
+# Check the fields of one stop update. Returns an error message, or None if
+# every field is one of stop_patch_columns with a valid value.
+def stop_patch_error(update_fields):
+    if not isinstance(update_fields, dict) or not update_fields:
+        return "No fields provided for update"
+    for key, value in update_fields.items():
+        if key not in stop_patch_columns:
+            return f"{key} is not a field that can be updated"
+        if value == '' or value is None:
+            return f"{key} is empty"
+        if key in ('latitude', 'longitude'):
+            bound = 90 if key == 'latitude' else 180
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < -bound or value > bound:
+                return f"{value} is an invalid input for {key}"
+        elif not isinstance(value, str):
+            return f"{value} is an invalid input for {key}"
+        if key == 'last_updated':
+            if not is_valid_datetime_format(value):
+                return f"{value} is an invalid format for {key}"
+    return None
+
+# Raised inside patch_stops_db's transaction to roll it back
+class StopsNotFound(Exception):
+    def __init__(self, stop_ids):
+        super().__init__(f"stops not found: {stop_ids}")
+        self.stop_ids = stop_ids
+
+# Apply validated updates, a list of (stop_id, update_fields), in one
+# transaction with one UPDATE per stop. last_updated is set to now unless the
+# update gives it. Returns the new last_updated of each stop in order.
+# Raises StopsNotFound, with nothing written, if any of the stops is missing.
+def patch_stops_db(updates):
+    conn = connect_to_database()
+    now = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    results = []
+    missing = []
+    with conn:
+        for stop_id, update_fields in updates:
+            values = dict(update_fields)
+            values.setdefault('last_updated', now)
+            # only whitelisted column names are put into the statement
+            columns = [column for column in stop_patch_columns if column in values]
+            assignments = ', '.join(f"{column} = ?" for column in columns)
+            row = conn.execute(f"UPDATE locations SET {assignments}, modified_at = {unix_now_sql} \
+                                 WHERE location_id = ? RETURNING last_updated",
+                               [values[column] for column in columns] + [stop_id]).fetchone()
+            if row is None:
+                missing.append(stop_id)
+            else:
+                results.append(row[0])
+        if missing:
+            raise StopsNotFound(missing)
+    return results
+
+
+# Settings for the Gemini operator profiles (can be overridden in the .env file)
+operator_profile_ttl     = float(os.environ.get("OPERATOR_PROFILE_TTL", 7 * 24 * 3600))
+operator_profile_timeout = float(os.environ.get("OPERATOR_PROFILE_TIMEOUT", 8))
+operator_profile_workers = int(os.environ.get("OPERATOR_PROFILE_WORKERS", 5))
+
+# Read the stored profiles for some operators as {name: (information, generated_at)}
+def get_operator_profiles_db(operator_names):
+    if not operator_names:
+        return {}
+    conn = connect_to_database()
     cursor = conn.cursor()
+    placeholders = ', '.join('?' for _ in operator_names)
+    cursor.execute(f"SELECT operator_name, information, generated_at FROM operator_profiles WHERE operator_name IN ({placeholders})",
+                   list(operator_names))
+    rows = cursor.fetchall()
+    return {name: (information, generated_at) for name, information, generated_at in rows}
+
+def save_operator_profile_db(operator_name, information):
+    conn = connect_to_database()
+    with conn:
+        conn.execute("INSERT INTO operator_profiles (operator_name, information, generated_at) VALUES (?, ?, ?) \
+                      ON CONFLICT(operator_name) DO UPDATE SET information = excluded.information, generated_at = excluded.generated_at",
+                     (operator_name, information, time.time()))
+
+# Return this process's Gemini model, creating it on first use
+def get_gemini():
+    global gemini
+    with gemini_lock:
+        if gemini is None:
+            import google.generativeai as genai
+            genai.configure(api_key=google_api_key or os.environ["GOOGLE_API_KEY"])
+            gemini = genai.GenerativeModel(gemini_model_name)
+        return gemini
+
+def ask_gemini(question):
+    return get_gemini().generate_content(question).text
+
+# Ask Gemini about one operator and store the answer. Runs on profile_executor.
+# Identical prompts that are already being answered share that answer.
+def generate_operator_profile(operator):
+    question = operator_profile_question(operator)
+    text = gemini_flight.do(question, ask_gemini, question)
+    information = operator_profile_information(text)
+    save_operator_profile_db(operator, information)
+    return information
+
+def operator_profile_question(operator):
+    return f"Give me a summary about the Dautsche Bahn operator {operator}!"
+
+# Flatten Gemini's markdown answer into the stored profile
+def operator_profile_information(text):
+    return text.replace('**', '').replace('\n', ' ')
+
+# Start generating a profile, or join the generation that is already running
+def submit_operator_profile(operator):
+    with profile_lock:
+        future = profile_in_flight.get(operator)
+        if future is not None:
+            # the same operator is already being generated, join that call
+            gemini_flight.record_coalesced()
+        else:
+            future = profile_executor.submit(generate_operator_profile, operator)
+            profile_in_flight[operator] = future
+            future.add_done_callback(lambda f: profile_in_flight.pop(operator, None))
+        return future
+
+def placeholder_profile(operator):
+    return f"Information about the operator {operator} is not available yet, please try again shortly."
+
+# Get a profile for every operator. Fresh profiles come from the database,
+# the rest are generated concurrently. Anything not ready within
+# operator_profile_timeout falls back to the stale stored profile, or a
+# placeholder, and keeps generating in the background for the next request.
+# With generate=False nothing is generated, as when the async mode already has.
+def get_operator_profiles(operator_names, generate=True):
+    return dict(iter_operator_profiles(operator_names, generate))
+
+# Yield (operator, information) for every operator as soon as each is ready:
+# the fresh stored ones first, then the generated ones in the order they
+# finish, then the fallbacks for any that didn't finish in time
+def iter_operator_profiles(operator_names, generate=True):
+    stored = get_operator_profiles_db(operator_names)
+    now = time.time()
+
+    def fallback(operator):
+        return stored[operator][0] if operator in stored else placeholder_profile(operator)
+
+    ready = []
+    pending = {}    # future -> operator
+    for operator in operator_names:
+        if operator in stored and now - stored[operator][1] < operator_profile_ttl:
+            ready.append((operator, stored[operator][0]))
+            metrics.inc('operator_profile_cache_hits')
+        elif not generate:
+            ready.append((operator, fallback(operator)))
+        else:
+            pending[submit_operator_profile(operator)] = operator
+            metrics.inc('operator_profile_cache_misses')
+    yield from ready
+    if not pending:
+        return
+
+    waited = 0
+    completed = as_completed(list(pending), timeout=operator_profile_timeout)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                future = next(completed)
+            except StopIteration:
+                break
+            finally:
+                waited += time.perf_counter() - started
+            operator = pending.pop(future)
+            if future.exception() is None:
+                yield operator, future.result()
+            else:
+                print('Error generating operator profile:', operator, future.exception())
+                yield operator, fallback(operator)
+    except FutureTimeoutError:
+        pass
+    record_phase('gemini', waited)
+    for operator in pending.values():
+        print('Operator profile not ready in time:', operator)
+        metrics.inc('operator_profile_timeouts')
+        yield operator, fallback(operator)
+
+
+# Settings for the background next_departure refresher (can be overridden in the .env file)
+refresher_enabled       = os.environ.get("REFRESHER_ENABLED", "0") == "1"
+refresher_interval      = float(os.environ.get("REFRESHER_INTERVAL", 60))     # seconds between cycles
+refresher_budget        = int(os.environ.get("REFRESHER_BUDGET", 20))         # upstream calls per cycle
+next_departure_max_age  = float(os.environ.get("NEXT_DEPARTURE_MAX_AGE", 90)) # seconds a stored value is served for
+
+# Count a request for a stop, by its integer location_id. Only the refresher
+# reads and decays the counts, so nothing is kept while it is off.
+def record_stop_request(location_id):
+    if not refresher_enabled:
+        return
+    with stop_request_lock:
+        stop_request_counts[location_id] = stop_request_counts.get(location_id, 0) + 1
+
+# True if the stored next_departure was refreshed recently enough to serve
+def next_departure_is_fresh(next_departure, refreshed_at):
+    return next_departure is not None and refreshed_at is not None \
+        and time.time() - refreshed_at <= next_departure_max_age
+
+# Pick the stops to refresh this cycle: stale ones only, most requested first
+# and then the longest since they were last tried, at most refresher_budget.
+# A stop counts as tried even when no departure was found or the call failed,
+# so those wait a cycle like the others instead of coming first every time.
+# The requested stops come from stop_request_counts, and the rest from the
+# locations_attempted_at index, so a cycle never reads every stale stop.
+def stops_due_for_refresh():
+    conn = connect_to_database()
+    cursor = conn.cursor()
+    # refresh a little early so requested stops never go stale between cycles
+    due_before = time.time() - max(next_departure_max_age - refresher_interval, 0)
+    with stop_request_lock:
+        counts = dict(stop_request_counts)
+        # let older popularity fade so the order follows what is busy now,
+        # on every cycle even if this one goes on to fail
+        for location_id in list(stop_request_counts):
+            stop_request_counts[location_id] //= 2
+            if stop_request_counts[location_id] == 0:
+                del stop_request_counts[location_id]
+    requested = sorted(counts, key=lambda location_id: -counts[location_id])
+
+    chosen = []
+    batch_size = 500
+    for start in range(0, len(requested), batch_size):
+        batch = requested[start:start + batch_size]
+        cursor.execute(f"SELECT location_id FROM locations WHERE location_id IN ({', '.join('?' * len(batch))}) \
+                         AND (next_departure_attempted_at IS NULL OR next_departure_attempted_at < ?)",
+                       (*batch, due_before))
+        stale = {row[0] for row in cursor.fetchall()}
+        chosen.extend(location_id for location_id in batch if location_id in stale)
+        if len(chosen) >= refresher_budget:
+            return chosen[:refresher_budget]
+
+    # fill the rest of the budget with the stops tried longest ago
+    cursor.execute("SELECT location_id FROM locations \
+                    WHERE next_departure_attempted_at IS NULL OR next_departure_attempted_at < ? \
+                    ORDER BY next_departure_attempted_at NULLS FIRST LIMIT ?", (due_before, refresher_budget + len(chosen)))
+    for row in cursor.fetchall():
+        if len(chosen) < refresher_budget and row[0] not in chosen:
+            chosen.append(row[0])
+    return chosen
+
+# Refresh next_departure for a batch of stops and store them in one transaction
+def refresh_next_departures():
+    updates = []
+    attempts = []
+    for location_id in stops_due_for_refresh():
+        try:
+            with closing(iter_departures(str(location_id), departures_window, PRIORITY_BACKGROUND)) as departures:
+                next_departure = find_next_departure(departures)
+        except requests.RequestException as e:
+            print('Error refreshing next departure:', location_id, e)
+            next_departure = None
+        if next_departure is not None:
+            updates.append((next_departure, time.time(), location_id))
+        else:
+            # the stored value stays stale, only the attempt is recorded
+            attempts.append((time.time(), location_id))
+
+    if updates or attempts:
+        conn = connect_to_database()
+        try:
+            with conn:
+                conn.executemany(f"UPDATE locations SET next_departure = ?1, next_departure_refreshed_at = ?2, \
+                                   next_departure_attempted_at = ?2, \
+                                   modified_at = CASE WHEN next_departure IS ?1 THEN modified_at ELSE {unix_now_sql} END \
+                                   WHERE location_id = ?3", updates)
+                conn.executemany("UPDATE locations SET next_departure_attempted_at = ? WHERE location_id = ?", attempts)
+        except sql.Error as e:
+            print("Error updating next departure:", e)
+    return len(updates)
+
+def run_refresher():
+    while True:
+        started = time.monotonic()
+        try:
+            refreshed = refresh_next_departures()
+            debug_print('Refreshed next departures:', refreshed)
+        except Exception as e:
+            print('Error in departure refresher:', e)
+        time.sleep(max(refresher_interval - (time.monotonic() - started), 0))
+
+# Start the refresher thread once, in the process that serves requests
+def start_refresher():
+    global refresher_thread
+    if not refresher_enabled or refresher_thread is not None:
+        return
+    with refresher_lock:
+        if refresher_thread is None:
+            refresher_thread = threading.Thread(target=run_refresher, name='departure-refresher', daemon=True)
+            refresher_thread.start()
+
+
+# Settings for the departures history (can be overridden in the .env file)
+history_enabled        = os.environ.get("HISTORY_ENABLED", "0") == "1"
+history_file           = os.environ.get("HISTORY_DB_FILE", f"{studentid}_history.db")
+history_retention_days = int(os.environ.get("HISTORY_RETENTION_DAYS", 30))
+history_flush_interval = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 5))   # seconds fetches are batched for
+history_queue_size     = int(os.environ.get("HISTORY_QUEUE_SIZE", 1000))      # fetches waiting to be written
+
+# The history keeps every departure seen upstream, in its own database file
+# so its writes never wait on the locations table's. Lines, operators and
+# directions are stored once in dictionary tables and referenced by id.
+# Departures go into one table per UTC day of their planned time, named
+# departures_YYYYMMDD, keyed by (stop_id, planned, line, direction) without
+# a rowid so a stop's departures are stored together in time order. A later
+# fetch of the same departure replaces it with the newer delay, and
+# retention drops whole days.
+history_dictionaries = ('lines', 'operators', 'directions')
+
+# This thread's connection to the history database, which stays open
+def connect_to_history():
+    conn = getattr(db_local, 'history_conn', None)
+    if conn is None:
+        conn = open_connection(history_file)
+        db_local.history_conn = conn
+    return conn
+
+def create_history_database():
+    conn = connect_to_history()
+    with conn:
+        for table in history_dictionaries:
+            # id 0 stands for a departure without one
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+            conn.execute(f"INSERT OR IGNORE INTO {table} (id, name) VALUES (0, '')")
+
+def history_partition(planned):
+    return 'departures_' + datetime.fromtimestamp(planned, timezone.utc).strftime('%Y%m%d')
+
+def create_history_partition(conn, partition):
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {partition}
+                    (stop_id INTEGER NOT NULL,
+                     planned INTEGER NOT NULL,
+                     line_id INTEGER NOT NULL,
+                     direction_id INTEGER NOT NULL,
+                     operator_id INTEGER NOT NULL,
+                     delay INTEGER,
+                     platform TEXT,
+                     planned_platform TEXT,
+                     cancelled INTEGER NOT NULL,
+                     observed INTEGER NOT NULL,
+                     PRIMARY KEY (stop_id, planned, line_id, direction_id)) WITHOUT ROWID''')
+    history_partitions_ready.add(partition)
+
+# Names of the day partitions in the history database, oldest first
+def history_partition_names(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'departures_[0-9]*' ORDER BY name")
+    return [row[0] for row in rows]
+
+# Id of a name in one of the dictionary tables, adding it if it's new
+def history_id(conn, table, name):
+    if not name:
+        return 0
+    key = (table, name)
+    id = history_ids.get(key)
+    if id is None:
+        id = conn.execute(f"INSERT INTO {table} (name) VALUES (?) ON CONFLICT(name) DO UPDATE SET name = excluded.name RETURNING id",
+                          (name,)).fetchone()[0]
+        history_ids[key] = id
+    return id
+
+# Turn one upstream departure into a history row, or None if it has no time
+def history_row(conn, stop_id, observed, entry):
+    value = entry.get('plannedWhen') or entry.get('when')
+    try:
+        planned = int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+    line = entry.get('line') or {}
+    return (stop_id, planned,
+            history_id(conn, 'lines', line.get('name')),
+            history_id(conn, 'directions', entry.get('direction')),
+            history_id(conn, 'operators', (line.get('operator') or {}).get('name')),
+            entry.get('delay'), entry.get('platform'), entry.get('plannedPlatform'),
+            1 if entry.get('cancelled') else 0, observed)
+
+# Insert history rows, grouped into their day partitions. Runs inside the
+# caller's transaction.
+def insert_history_rows(conn, rows):
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(history_partition(row[1]), []).append(row)
+    for partition, partition_rows in partitions.items():
+        if partition not in history_partitions_ready:
+            create_history_partition(conn, partition)
+        conn.executemany(f"INSERT OR REPLACE INTO {partition} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", partition_rows)
+
+# Write a batch of queued fetches in one transaction. Returns the rows written.
+def write_history(batch):
+    conn = connect_to_history()
+    rows = []
+    try:
+        with conn:
+            for stop_id, fetched_at, departures in batch:
+                observed = int(fetched_at.timestamp())
+                for entry in departures:
+                    row = history_row(conn, int(stop_id), observed, entry)
+                    if row is not None:
+                        rows.append(row)
+            insert_history_rows(conn, rows)
+    except Exception:
+        # ids and tables added in the rolled back transaction are gone again
+        history_ids.clear()
+        history_partitions_ready.clear()
+        raise
+    return len(rows)
+
+# Drop the day partitions older than history_retention_days
+def prune_history():
+    conn = connect_to_history()
+    oldest = history_partition(int(time.time()) - history_retention_days * 86400)
+    dropped = 0
+    with conn:
+        for partition in history_partition_names(conn):
+            if partition < oldest:
+                conn.execute(f"DROP TABLE {partition}")
+                history_partitions_ready.discard(partition)
+                dropped += 1
+    return dropped
+
+# Queue a fetched departures window for the history writer. Never blocks: if
+# the writer has fallen behind, the fetch is dropped and counted.
+def record_departures(stop_id, fetched_at, departures):
+    if not history_enabled:
+        return
+    start_history_writer()
+    try:
+        history_queue.put_nowait((stop_id, fetched_at, departures))
+    except queue.Full:
+        metrics.inc('history_fetches_dropped')
+
+def run_history_writer():
+    pruned_at = 0
+    while True:
+        # wait for one fetch, then gather whatever arrives in the next history_flush_interval
+        batch = [history_queue.get()]
+        deadline = time.monotonic() + history_flush_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(history_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            metrics.inc('history_rows_written', write_history(batch))
+            if time.monotonic() - pruned_at > 3600:
+                pruned_at = time.monotonic()
+                print('Pruned departures history partitions:', prune_history())
+        except Exception as e:
+            print('Error writing departures history:', e)
+
+# Start the history writer thread once, on the first fetch to record
+def start_history_writer():
+    global history_writer_thread
+    if history_writer_thread is not None:
+        return
+    with history_lock:
+        if history_writer_thread is None:
+            history_writer_thread = threading.Thread(target=run_history_writer, name='history-writer', daemon=True)
+            history_writer_thread.start()
+
+# Departures, average delay and platform changes per hour at a stop between
+# two unix times, read from the day partitions that cover them. With
+# by='hour_of_day' the days are folded into 24 buckets (UTC).
+# Returns (bucket, departures, average delay in seconds, platform changes) rows.
+def departure_delay_by_hour(stop_id, since, until, by='hour'):
+    conn = connect_to_history()
+    first, last = history_partition(since), history_partition(until)
+    partitions = [name for name in history_partition_names(conn) if first <= name <= last]
+    if not partitions:
+        return []
+    bucket = 'planned / 3600 * 3600' if by == 'hour' else 'planned % 86400 / 3600'
+    union = ' UNION ALL '.join(
+        f"SELECT planned, delay, platform, planned_platform FROM {partition} WHERE stop_id = ? AND planned >= ? AND planned < ?"
+        for partition in partitions)
+    cursor = conn.execute(f"SELECT {bucket} AS bucket, COUNT(*), AVG(delay), SUM(platform IS NOT planned_platform) \
+                            FROM ({union}) GROUP BY bucket ORDER BY bucket",
+                          [int(stop_id), since, until] * len(partitions))
+    return cursor.fetchall()
+
+
+# Create the shared clients, caches, pools and locks. Runs at import, again
+# from create_app() once its config is applied, and in every forked child,
+# because connections, pooled sockets and pool threads can't be shared
+# across a fork.
+def init_services():
+    global upstream_limiter, upstream, upstream_flight, gemini_flight, departures_cache, lookup_executor
+    global db_local, gemini, gemini_lock, profile_executor, profile_in_flight, profile_lock
+    global stop_request_counts, stop_request_lock, refresher_thread, refresher_lock, metrics
+    global history_queue, history_writer_thread, history_lock, history_ids, history_partitions_ready, import_lock
+
+    # Counters and histograms for /metrics
+    metrics = Metrics()
+
+    # transport.rest client, its rate limiter and the departures cache
+    upstream_limiter = RateLimiter(upstream_rate_per_minute, upstream_burst)
+    upstream = UpstreamClient(transport_base_url, upstream_connect_timeout, upstream_read_timeout,
+                              upstream_max_retries, upstream_backoff, upstream_pool_size, upstream_limiter)
+    departures_cache = DeparturesCache(departures_cache_ttl, departures_cache_max_bytes)
+
+    # One flight group for the transport.rest calls and one for the Gemini prompts
+    upstream_flight = SingleFlight()
+    gemini_flight = SingleFlight()
+
+    # Bounded pool for the /locations lookups of a bulk PUT /stops
+    lookup_executor = ThreadPoolExecutor(max_workers=upstream_lookup_workers, thread_name_prefix='lookup')
+
+    # One long-lived connection per thread, opened on first use
+    db_local = threading.local()
+
+    # Gemini model, created by get_gemini() on first use
+    gemini = None
+    gemini_lock = threading.Lock()
+
+    # Bounded pool for the Gemini calls, and the generations currently running on it
+    profile_executor = ThreadPoolExecutor(max_workers=operator_profile_workers, thread_name_prefix='gemini')
+    profile_in_flight = {}
+    profile_lock = threading.Lock()
+
+    # How often each stop has been requested recently, used to refresh the
+    # busiest stops first. The counts are halved after every refresh cycle.
+    stop_request_counts = {}
+    stop_request_lock = threading.Lock()
+    refresher_thread = None
+    refresher_lock = threading.Lock()
+
+    # Fetches waiting for the history writer, and the writer's caches of
+    # dictionary ids and existing partitions
+    history_queue = queue.Queue(maxsize=history_queue_size)
+    history_writer_thread = None
+    history_lock = threading.Lock()
+    history_ids = {}
+    history_partitions_ready = set()
+
+    # Held while a bulk import has the index triggers dropped
+    import_lock = threading.Lock()
+
+# Connections opened before a fork belong to the parent. The child keeps them
+# referenced so they are never closed there, since closing one could
+# checkpoint and remove the WAL files the parent is still using.
+inherited_db_locals = []
+
+def reset_after_fork():
+    inherited_db_locals.append(db_local)
+    init_services()
+
+init_services()
+os.register_at_fork(after_in_child=reset_after_fork)
+
+# Settings that create_app() accepts in its config
+settings_names = {
+    'db_file', 'google_api_key', 'gemini_model_name',
+    'transport_base_url', 'upstream_connect_timeout', 'upstream_read_timeout', 'upstream_max_retries',
+    'upstream_backoff', 'upstream_pool_size', 'upstream_lookup_workers',
+    'upstream_rate_per_minute', 'upstream_burst', 'upstream_queue_timeout', 'upstream_background_queue_timeout',
+    'departures_cache_ttl', 'departures_cache_max_bytes', 'departures_streaming',
+    'db_busy_timeout', 'db_cache_size', 'db_mmap_size',
+    'local_search_min_matches', 'local_search_max_age',
+    'operator_profile_ttl', 'operator_profile_timeout', 'operator_profile_workers',
+    'refresher_enabled', 'refresher_interval', 'refresher_budget', 'next_departure_max_age',
+    'import_chunk_size', 'history_enabled', 'history_file', 'history_retention_days', 'history_flush_interval', 'history_queue_size',
+    'debug_prints', 'async_workers', 'async_limiter_poll',
+}
+
+# Database files whose tables have been created by this process
+schema_ready = set()
+
+# Build the Flask app. `config` overrides any of the settings in this module
+# by name, e.g. create_app({'db_file': 'test.db', 'refresher_enabled': True}).
+# The tables are created once per database file.
+def create_app(config=None):
+    for key, value in (config or {}).items():
+        if key not in settings_names:
+            raise KeyError(f'unknown setting {key}')
+        globals()[key] = value
+    if config:
+        init_services()
+
+    if db_file not in schema_ready:
+        create_database()
+        schema_ready.add(db_file)
+    if history_enabled and history_file not in schema_ready:
+        create_history_database()
+        schema_ready.add(history_file)
+
+    app = Flask(__name__)
+    api.init_app(app)
+    app.before_request(start_request_timer)
+    app.before_request(start_refresher)
+    app.after_request(add_server_timing)
+    app.cli.command('import-stops')(import_stops_command)
+    return app
+
+# flask --app z5312750 import-stops stops.txt [more files...]
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def import_stops_command(paths):
+    for path in paths:
+        started = time.perf_counter()
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            imported, skipped, errors = import_stops(f)
+        print(f'{path}: imported {imported} stops, skipped {skipped} rows in {time.perf_counter() - started:.1f}s')
+        for error in errors:
+            click.echo(f'{path}: error: {error}', err=True)
+        if errors and not imported:
+            raise click.ClickException(f'{path}: no stops imported')
+
+def start_request_timer():
+    # in the async mode the request started, and may have spent time, on the event loop
+    g.request_started = request.environ.get('prefetch.started', time.perf_counter())
+    g.timings = dict(request.environ.get('prefetch.timings', {}))
+
+# Report where the request's time went in a Server-Timing header, e.g.
+# "upstream;dur=48.2, db;dur=0.9, serialise;dur=0.1, total;dur=51.0",
+# and record its latency for /metrics
+def add_server_timing(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    phases = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in g.get('timings', {}).items()]
+    phases.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers['Server-Timing'] = ', '.join(phases)
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe_request(request.method, endpoint, response.status_code, elapsed)
+    return response
+
+# Convert response data to a JSON string, timed as the 'serialise' phase
+def to_json(data):
+    with timed('serialise'):
+        return json.dumps(data)
+
+
+# The queries of a PUT /stops: every 'query' parameter, or else the list in
+# the JSON body, either bare or as {"queries": [...]}
+def put_queries(query_args, body):
+    queries = query_args
+    if not queries:
+        if isinstance(body, dict):
+            body = body.get('queries')
+        if isinstance(body, list):
+            queries = [query for query in body if isinstance(query, str)]
+    return [query for query in queries if query]
+
+
+# Fields the 'include' parameter can select, the others are always sent
+optional_stop_fields = ['name', 'latitude', 'longitude', 'next_departure']
+
+# Drop the optional fields that are not listed in the 'include' parameter
+def apply_include(response_data, include_fields):
+    if include_fields[0] != '':
+        for field in optional_stop_fields:
+            if field not in include_fields:
+                response_data.pop(field, None)
+    return response_data
+
+# Build the representation of a stop row for the GET /stops listing
+def stop_listing_item(row, include_fields):
+    stop_id, last_updated, name, latitude, longitude, next_departure, modified_at = row
+    response_data = {
+            "stop_id": stop_id,
+            "last_updated": last_updated,
+            "name": name, 
+            "latitude": latitude, 
+            "longitude": longitude, 
+            "next_departure": next_departure, 
+            "_links": {
+                "self": {
+                    "href": f"http://localhost:8888/stops/{stop_id}"
+                }
+            }
+    }
+    return apply_include(response_data, include_fields)
+
+# ETag for a representation, from everything that goes into its body
+def make_etag(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+# Last-Modified for a representation from the unix time anything in it last
+# changed (modified_at, see stop_info_columns), in whole seconds as HTTP dates
+# are. None while that second is still going on, since a second change within
+# it would get the same date and be missed by If-Modified-Since.
+def stop_last_modified(changed_at):
+    if not changed_at or int(changed_at) >= int(time.time()):
+        return None
+    return datetime.fromtimestamp(int(changed_at), timezone.utc)
+
+# True if the client's copy, named by If-None-Match or else If-Modified-Since,
+# is still current. If-None-Match compares weakly (RFC 9110 13.1.2), so a
+# tag a proxy or compressing server marked W/ still matches.
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+# Add the validators to a response, or build an empty 304 if there is none
+def set_validators(response, etag, last_modified):
+    if response is None:
+        response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
 
-    # Update the field with the new value based on the condition
-    cursor.execute(f"UPDATE {table} SET {field} = ? WHERE {condition_field} = ?", (value, condition_value))
-    conn.commit()
 
-    conn.close()
+@api.route('/stops')
+class AddStops(Resource):
+    @api.doc(params={'cursor': 'Return the stops after this stop_id',
+                     'limit': 'Number of stops per page (default 100, at most 1000)',
+                     'include': 'Fields to include for each stop',
+                     'format': "'ndjson' to stream one stop per line; without a limit this exports every stop"})
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    def get(self):
+        ndjson = request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best == 'application/x-ndjson'
+        try:
+            after = int(request.args.get('cursor', -1))
+            limit = request.args.get('limit')
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            return {'error': 'cursor and limit must be integers'}, 400
+        if limit is not None and (limit < 1 or (not ndjson and limit > 1000)):
+            return {'error': f'{limit} is an invalid input for limit'}, 400
+        include_fields = request.args.get('include', '').split(',')
+
+        # Stream the rows as they come off the database, one JSON object per line
+        if ndjson:
+            def generate():
+                for row in iter_stops_db(after, limit):
+                    yield json.dumps(stop_listing_item(row, include_fields)) + '\n'
+            return Response(generate(), status=200, mimetype='application/x-ndjson')
 
-def get_field_value_from_db(table, field, condition_field, condition_value):
-    conn = sql.connect(db_file)  
-    cursor = conn.cursor()
+        # Otherwise send one page, with a link to the next one if there is more
+        limit = limit or 100
+        rows = get_stops_page_db(after, limit + 1)
 
-    # Execute the SELECT query to retrieve the value of the specified field
-    cursor.execute(f"SELECT {field} FROM {table} WHERE {condition_field} = ?", (condition_value,))
-    row = cursor.fetchone()
+        # Answer 304 if the client already has this page, before building it
+        etag = make_etag(rows, request.full_path)
+        # every row read counts, the one past the page decides the next link
+        last_modified = stop_last_modified(max([row[6] or 0 for row in rows] + [get_last_delete_db()]))
+        if not_modified(etag, last_modified):
+            return set_validators(None, etag, last_modified)
 
-    if row:
-        value = row[0]  # Extract the value from the first column of the result row
-    else:
-        value = None
+        response_data = {
+                "stops": [stop_listing_item(row, include_fields) for row in rows[:limit]],
+                "_links": {
+                    "self": {
+                        "href": f"http://localhost:8888{request.full_path.rstrip('?')}"
+                    }
+                }
+        }
+        if len(rows) > limit:
+            next_cursor = rows[limit - 1][0]
+            include = request.args.get('include')
+            include_param = f"&include={include}" if include else ''
+            response_data['_links']['next'] = {'href': f"http://localhost:8888/stops?cursor={next_cursor}&limit={limit}{include_param}"}
 
-    conn.close()
-    return value
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
 
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
 
+        # Return the Flask Response object, with its validators
+        return set_validators(response, etag, last_modified)
 
-@api.route('/stops')
-class AddStops(Resource):
-    @api.doc(params={'query': 'The query string for the stop'})
+    @api.doc(params={'query': 'The query string for the stop, can be repeated to add several at once',
+                     'local': "'1' to answer queries from the stored stops when they have enough fresh matches"},
+             description='Queries can also be sent as a JSON body: a list of strings or {"queries": [...]}')
     @api.response(201, 'CREATED')
     @api.response(400, 'Bad Request')
     @api.response(404, 'Not Found')
+    @api.response(503, 'Service Unavailable')
     def put(self):
-        # Get the value of the 'query' parameter from the request
-        query = request.args.get('query')
-        print("this is the query", query)
+        # Get every 'query' parameter from the request, or the queries in the JSON body
+        queries = put_queries(request.args.getlist('query'), request.get_json(silent=True))
+        debug_print("this is the query", queries)
 
         # Check if the 'query' parameter is present
-        if not query:
+        if not queries:
             return {'error': 'No query provided'}, 400
 
-        # Construct the URL for the external API request with the 'query' parameter value inserted
-        api_url = f'https://v6.db.transport.rest/locations?query={query}&results=5'
-
-        # Make a request to the external API
-        response = requests.get(api_url)
-        print('this is the reqponse', response)
-
-        # Check if the request to the external API was successful
-        if response.status_code != 200:
+        # In local mode, answer the queries that have enough fresh matches in
+        # the database from the name index and only send the rest upstream
+        local_stops = {}
+        if request.args.get('local') in ('1', 'true'):
+            upstream_queries = []
+            for query in queries:
+                matches = search_locations_db(query, 5)
+                if len(matches) >= local_search_min_matches and all(stop_is_fresh(match[4]) for match in matches):
+                    for location_id, name, latitude, longitude, last_updated in matches:
+                        local_stops[str(location_id)] = parse_last_updated(last_updated).astimezone().strftime("%Y-%m-%d-%H:%M:%S")
+                else:
+                    upstream_queries.append(query)
+            debug_print('answered locally', len(queries) - len(upstream_queries), 'of', len(queries))
+            queries = upstream_queries
+
+        # Make the requests to the external API concurrently through the shared client
+        stop_data = []
+        try:
+            if queries:
+                stop_data = lookup_many_locations(queries, request.environ.get('prefetch.locations'))
+        except RateLimitExceeded:
+            return {'error': 'Too many requests to the external API, please try again shortly'}, 503
+        except requests.RequestException:
             return {'error': 'Failed to fetch stop data from external API'}, 500
+        debug_print('this is the json data', stop_data)
 
-        # Extract stop data from the API response
-        stop_data = response.json()
-        print('this is the json data', stop_data)
-
-        # Connect to the SQLite database
-        conn = connect_to_database()
-        cursor = conn.cursor()
-
-        # Iterate over the stop data and insert into the SQLite database
+        # Insert or update every stop with one statement in one transaction
         sorted_stop_data = sorted(stop_data, key=lambda x: int(x['id']))
-        for item in sorted_stop_data:
-            item_id = item['id']
-            item_name = item['name']
-            item_latitude = item['location']['latitude']
-            item_longitude = item['location']['longitude']
-            # Check if the stop_id already exists in the database
-            cursor.execute("SELECT location_id FROM locations WHERE location_id=?", (item_id,))
-            existing_stop = cursor.fetchone()
-            if existing_stop:
-                # Update the last_updated timestamp if the stop already exists
-                cursor.execute("UPDATE locations SET last_updated = datetime('now'), \
-                name = ?, \
-                latitude = ?, \
-                longitude = ? \
-                WHERE location_id = ?", (item_name, item_latitude, item_longitude, item_id))
-
-                print('existing')
+        upsert_locations([
+            (item['id'], item['name'], item['location']['latitude'], item['location']['longitude'])
+            for item in sorted_stop_data
+        ])
 
-            else:
-                # Insert the stop data into the database if it doesn't exist
-                link_self_href =  f"http://localhost:8888/stops/{item_id}"
-                cursor.execute("INSERT INTO locations (location_id, last_updated, name, latitude, longitude, link_self_href) VALUES (?, datetime('now'), ?, ?, ?, ?)",
-                (item_id, item_name, item_latitude, item_longitude, link_self_href))
-                print('new location')
-        # Commit changes and close connection
-        conn.commit()
-        conn.close()
+        # Stops fetched now were just updated, local ones keep their stored time
+        last_updated = dict(local_stops)
+        for stop in sorted_stop_data:
+            last_updated[stop['id']] = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
 
         # Construct the response in the desired format
         response_data = [
             {
-                "stop_id": stop['id'],
-                "last_updated": datetime.now().strftime("%Y-%m-%d-%H:%M:%S"),
+                "stop_id": stop_id,
+                "last_updated": last_updated[stop_id],
                 "_links": {
                     "self": {
-                        "href": f"http://localhost:8888/stops/{stop['id']}"
+                        "href": f"http://localhost:8888/stops/{stop_id}"
                     }
                 }
             }
-            for stop in sorted_stop_data
+            for stop_id in sorted(last_updated, key=int)
         ]
-        print(response_data)
+        debug_print(response_data)
         # Convert the response_data to JSON string
-        json_data = json.dumps(response_data)
+        json_data = to_json(response_data)
 
         # Create a Flask Response object
         response = Response(response=json_data, status=201, mimetype='application/json')
@@ -299,6 +2025,196 @@ class AddStops(Resource):
         return response
     
 
+    @api.expect([api.model('UpdateStopsItem', {
+        'stop_id': fields.Integer(description='Stop to update', required=True),
+        'last_updated': fields.String(description='Time last updated'),
+        'name': fields.String(description='Name of the stop'),
+        'latitude': fields.Float(description='Latitude of the stop'),
+        'longitude': fields.Float(description='Longitude of the stop'),
+        'next_departure': fields.String(description='Next departure')
+    })])
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    @api.response(404, 'Not Found')
+    def patch(self):
+        # A list of updates, each with the stop_id and the fields to change
+        body = request.get_json(silent=True)
+        if not isinstance(body, list) or not body:
+            return {"error": "Expected a list of stop updates"}, 400
+
+        # check every update before writing any of them
+        updates = []
+        for index, item in enumerate(body):
+            if not isinstance(item, dict) or 'stop_id' not in item:
+                return {"error": f"update {index} has no stop_id"}, 400
+            update_fields = {key: value for key, value in item.items() if key != 'stop_id'}
+            error = stop_patch_error(update_fields)
+            if error:
+                return {"error": f"update {index}: {error}"}, 400
+            updates.append((str(item['stop_id']), update_fields))
+
+        # apply them all in one transaction, or none if a stop is missing
+        try:
+            last_updated = patch_stops_db(updates)
+        except StopsNotFound as e:
+            return {"error": "Stops not found", "stop_ids": e.stop_ids}, 404
+
+        response_data = [
+            {
+                "stop_id": stop_id,
+                "last_updated": stop_last_updated,
+                "_links": {
+                    "self": {
+                        "href": f"http://localhost:8888/stops/{stop_id}"
+                    }
+                }
+            }
+            for (stop_id, update_fields), stop_last_updated in zip(updates, last_updated)
+        ]
+
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
+
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
+
+        # Return the Flask Response object
+        return response
+
+
+@api.route('/stops/import')
+class ImportStops(Resource):
+    @api.doc(description='Bulk load a GTFS stops.txt or DB station list sent as the CSV request body')
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    @api.response(409, 'Conflict')
+    def post(self):
+        if import_lock.locked():
+            return {'error': 'An import is already running'}, 409
+        # read the body as it arrives instead of buffering all of it
+        file = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+        started = time.perf_counter()
+        try:
+            imported, skipped, errors = import_stops(file)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        # nothing loaded because of the ids is a bad file, not a partial import
+        if errors and not imported:
+            return {'error': ' '.join(errors), 'skipped': skipped}, 400
+
+        response_data = {
+            "imported": imported,
+            "skipped": skipped,
+            "errors": errors,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
+
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
+
+        # Return the Flask Response object
+        return response
+
+
+@api.route('/stops/search')
+class SearchStops(Resource):
+    @api.doc(params={'q': 'Words to look for in the stop names',
+                     'limit': 'Maximum number of stops to return (default 10, at most 100)'})
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    def get(self):
+        text = request.args.get('q', '')
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            return {'error': 'limit must be an integer'}, 400
+        if not fts_query(text):
+            return {'error': 'No query provided'}, 400
+        if limit < 1 or limit > 100:
+            return {'error': f'{limit} is an invalid input for limit'}, 400
+
+        # Construct the response in the desired format
+        response_data = [
+            {
+                "stop_id": stop_id,
+                "name": name,
+                "latitude": latitude,
+                "longitude": longitude,
+                "last_updated": last_updated,
+                "_links": {
+                    "self": {
+                        "href": f"http://localhost:8888/stops/{stop_id}"
+                    }
+                }
+            }
+            for stop_id, name, latitude, longitude, last_updated in search_locations_db(text, limit)
+        ]
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
+
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
+
+        # Return the Flask Response object
+        return response
+
+
+@api.route('/stops/nearby')
+class NearbyStops(Resource):
+    @api.doc(params={'lat': 'Latitude of the point to search around',
+                     'lon': 'Longitude of the point to search around',
+                     'radius': 'Search radius in metres (default 1000, at most 50000)',
+                     'limit': 'Maximum number of stops to return (default 10, at most 100)'})
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    def get(self):
+        # Parse and check the query parameters
+        try:
+            latitude = float(request.args['lat'])
+            longitude = float(request.args['lon'])
+            radius = float(request.args.get('radius', 1000))
+            limit = int(request.args.get('limit', 10))
+        except (KeyError, ValueError):
+            return {'error': 'lat and lon are required, and lat, lon, radius and limit must be numbers'}, 400
+        if latitude < -90 or latitude > 90:
+            return {'error': f'{latitude} is an invalid input for lat'}, 400
+        if longitude < -180 or longitude > 180:
+            return {'error': f'{longitude} is an invalid input for lon'}, 400
+        if radius <= 0 or radius > 50000:
+            return {'error': f'{radius} is an invalid input for radius'}, 400
+        if limit < 1 or limit > 100:
+            return {'error': f'{limit} is an invalid input for limit'}, 400
+
+        stops = find_nearby_stops(latitude, longitude, radius, limit)
+
+        # Construct the response in the desired format
+        response_data = [
+            {
+                "stop_id": stop_id,
+                "name": name,
+                "latitude": stop_latitude,
+                "longitude": stop_longitude,
+                "distance": round(distance, 1),
+                "_links": {
+                    "self": {
+                        "href": f"http://localhost:8888/stops/{stop_id}"
+                    }
+                }
+            }
+            for stop_id, name, stop_latitude, stop_longitude, distance in stops
+        ]
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
+
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
+
+        # Return the Flask Response object
+        return response
+
 
 @api.route('/stops/<stop_id>')
 class Stop(Resource):
@@ -306,59 +2222,65 @@ class Stop(Resource):
     @api.response(200, 'OK')
     @api.response(400, 'Bad Request')
     @api.response(404, 'Not Found')
+    @api.response(503, 'Service Unavailable')
     def get(self, stop_id):
         # query = request.args.get('stop_id')
         query = stop_id
-        print("this is the query", query)
+        debug_print("this is the query", query)
 
         # Check if the 'query' parameter is present
         if not query:
             return {'error': 'No query provided'}, 400
         id = query
-        # check stop id in db
-        if not check_in_db("locations", id):
+        # check stop id in db, reading the stored row at the same time
+        stop_info = get_stop_info_db(id)
+        if not stop_info:
             return {'error': 'Stop not in database'}, 400
-        
-        # Construct the URL for the external API request with the 'query' parameter value inserted
-        api_url = f'https://v6.db.transport.rest/stops/{id}/departures?duration=120'
-
-        # Make a request to the external API
-        response = requests.get(api_url)
-        print('this is the reqponse', response)
+        record_stop_request(stop_info[0])
 
-        # Check if the request to the external API was successful
-        if response.status_code != 200:
-            return {'error': 'Failed to fetch stop data from external API'}, 500
-
-        # Extract stop data from the API response
-        platform = None
-        direction = None
-        response = response.json()
-        for entry in response['departures']:
-            if entry.get('platform') is not None and entry.get('direction') is not None:
-                print('not null!!!!!!')
-                platform = entry['platform']
-                direction = entry['direction']
-                break
-        
-        print('platform and direction', platform, direction)
-        if platform is None or direction is None:
-            return {'error': 'No next departure found for this stop'}, 404
-        # update the db
-        next_departure = f'Platform {platform} towards {direction}'
-        update_next_departure(id, next_departure)
+        # Parse the 'include' query parameter
+        include_fields = request.args.get('include', '').split(',')
+        debug_print('include!!', include_fields)
+
+        # Only go to the external API if the stored next departure is stale
+        fresh = next_departure_is_fresh(stop_info[5], stop_info[8])
+        if fresh:
+            # Answer 304 if the client already has this stop, before building it
+            etag = make_etag(stop_info[:8], include_fields)
+            last_modified = stop_last_modified(stop_info[9])
+            if not_modified(etag, last_modified):
+                return set_validators(None, etag, last_modified)
+        else:
+            # Get the departures from the cache, or the external API on a miss
+            # and stop reading them at the first one with a platform
+            try:
+                with closing(iter_departures(id, 120)) as departures:
+                    # Extract the next departure from the API response
+                    next_departure = find_next_departure(departures)
+            except RateLimitExceeded:
+                return {'error': 'Too many requests to the external API, please try again shortly'}, 503
+            except requests.RequestException:
+                return {'error': 'Failed to fetch stop data from external API'}, 500
+            debug_print('next departure', next_departure)
+            if next_departure is None:
+                return {'error': 'No next departure found for this stop'}, 404
+
+            # update the db and read the stop back with its neighbours
+            stop_info = update_next_departure(id, next_departure)
 
         # provide response
         # Construct the response in the desired format
-        stop_info = get_stop_info_db(id)
-        # Unpack the result tuple into separate variables
-        if stop_info:
-            stop_id, last_updated, name, latitude, longitude, next_departure = stop_info
-        else:
+        if not stop_info:
             print("No information found for location ID:", id)
-        
-        # get prev and next 
-        prev, next = get_prev_next(id)
+            return {'error': 'Stop not in database'}, 400
+        if not fresh:
+            # The refresh may have left the stop as the client has it
+            etag = make_etag(stop_info[:8], include_fields)
+            last_modified = stop_last_modified(stop_info[9])
+            if not_modified(etag, last_modified):
+                return set_validators(None, etag, last_modified)
+        # Unpack the result tuple into separate variables
+        stop_id, last_updated, name, latitude, longitude, next_departure, prev, next, refreshed_at, changed_at = stop_info
         response_data = {
                 "stop_id": stop_id,
                 "last_updated": last_updated,
@@ -372,32 +2294,20 @@ class Stop(Resource):
                     }, 
                 }
         }
-        # Parse the 'include' query parameter
-        include_fields = request.args.get('include', '').split(',')
-        print('include!!', include_fields)
-    
         # Include fields in the response data based on the 'include' query parameter
-        if include_fields[0] != '':
-            if 'name' not in include_fields:
-                response_data.pop('name', None)
-            if 'latitude' not in include_fields:
-                response_data.pop('latitude', None)
-            if 'longitude' not in include_fields:
-                response_data.pop('longitude', None)
-            if 'next_departure' not in include_fields:
-                response_data.pop('next_departure', None)
-        if prev:
-            response_data['_links']['prev'] = {'href': f"http://localhost:8888/stops/{prev[0]}"}
-        if next:
-            response_data['_links']['next'] = {'href': f"http://localhost:8888/stops/{next[0]}"}
-        print(response_data)
+        apply_include(response_data, include_fields)
+        if prev is not None:
+            response_data['_links']['prev'] = {'href': f"http://localhost:8888/stops/{prev}"}
+        if next is not None:
+            response_data['_links']['next'] = {'href': f"http://localhost:8888/stops/{next}"}
+        debug_print(response_data)
         # Convert the response_data to JSON string
-        json_data = json.dumps(response_data)
+        json_data = to_json(response_data)
 
         # Create a Flask Response object
         response = Response(response=json_data, status=200, mimetype='application/json')
-        # Return the Flask Response object
-        return response
+        # Return the Flask Response object, with its validators
+        return set_validators(response, etag, last_modified)
     @api.response(200, 'OK')
     @api.response(400, 'Bad Request')
     @api.response(404, 'Not Found')
@@ -420,36 +2330,20 @@ class Stop(Resource):
         'next_departure': fields.String(description='Next departure')
     }))
     def patch(self, stop_id):
-        if not check_in_db("locations", stop_id):
-            return {"error": "Stop not found"}, 404
-
-        update_fields = request.json
-        if not update_fields:
-            return {"error": "No fields provided for update"}, 400
-
-        print('here', update_fields)
+        update_fields = request.get_json(silent=True)
+        debug_print('here', update_fields)
 
         # check valid input for fields
-        for key in update_fields.keys():
-            if update_fields[key] == '':
-                return  {"error": f"{key} is empty"}, 400
-            if key == 'latitude':
-                if update_fields[key] < -90 or update_fields[key] > 90:
-                    return  {"error": f"{update_fields[key]} is an invalid input for {key}"}, 400
-            if key == 'longitude':
-                if update_fields[key] < -180 or update_fields[key] > 180:
-                    return  {"error": f"{update_fields[key]} is an invalid input for {key}"}, 400
-            if key == 'last_updated':
-                if not is_valid_datetime_format(update_fields[key]):
-                    return  {"error": f"{update_fields[key]} is an invalid format for {key}"}, 400
-
-        # update values
-        for key in update_fields.keys():
-            update_field_in_db("locations", key, update_fields[key], "location_id", stop_id)
-        if 'last_updated' not in update_fields.keys():
-            update_field_in_db("locations", 'last_updated', datetime.now().strftime("%Y-%m-%d-%H:%M:%S"), "location_id", stop_id)
+        error = stop_patch_error(update_fields)
+        if error:
+            return {"error": error}, 400
+
+        # update every field and last_updated in one statement
+        try:
+            last_updated, = patch_stops_db([(stop_id, update_fields)])
+        except StopsNotFound:
+            return {"error": "Stop not found"}, 404
         # Construct the response in the desired format
-        last_updated = get_field_value_from_db("locations", "last_updated", 'location_id', stop_id)
 
         response_data = {
                 "stop_id": stop_id,
@@ -462,7 +2356,7 @@ class Stop(Resource):
         }
 
         # Convert the response_data to JSON string
-        json_data = json.dumps(response_data)
+        json_data = to_json(response_data)
 
         # Create a Flask Response object
         response = Response(response=json_data, status=200, mimetype='application/json')
@@ -470,46 +2364,57 @@ class Stop(Resource):
         # Return the Flask Response object
         return response
 
+# 'ndjson' or 'sse' if a departures request asks for its profiles streamed,
+# by its format parameter or else its Accept header, otherwise None
+def departures_stream_format(format_param, accept):
+    if format_param is None:
+        format_param = {'application/x-ndjson': 'ndjson', 'text/event-stream': 'sse'}.get(accept.best)
+    return format_param if format_param in ('ndjson', 'sse') else None
+
 @api.route('/stops/<stop_id>/departures')
 class Stop(Resource):
+    @api.doc(params={'format': "'ndjson' or 'sse' to stream the stop and then each operator profile as it is ready"})
     @api.response(200, 'OK')
     @api.response(400, 'Bad Request')
     @api.response(404, 'Not Found')
+    @api.response(503, 'Service Unavailable')
     def get(self, stop_id):
         
         # check stop in db
         if not check_in_db("locations", stop_id):
             return {"error": "Stop not found"}, 404
-        # use api for this stop
-        # Construct the URL for the external API request with the 'query' parameter value inserted
-        api_url = f'https://v6.db.transport.rest/stops/{stop_id}/departures?duration=90'
+        # use api for this stop, sliced from the shared departures cache,
+        # and stop reading departures once there are five operators
+        try:
+            with closing(iter_departures(stop_id, 90)) as departures:
+                # get info for each operator
+                operator_names = find_operator_names(departures, 5)
+        except RateLimitExceeded:
+            return {'error': 'Too many requests to the external API, please try again shortly'}, 503
+        except requests.RequestException:
+            return {'error': 'Failed to fetch stop data from external API'}, 500
 
-        # Make a request to the external API
-        response = requests.get(api_url)
-        print('this is the reqponse', response)
+        debug_print(operator_names)
+        generate = 'prefetch.profiles' not in request.environ
 
-        # Check if the request to the external API was successful
-        if response.status_code != 200:
-            return {'error': 'Failed to fetch stop data from external API'}, 500
+        # Streamed: the stop first, then each profile as soon as it is ready
+        stream = departures_stream_format(request.args.get('format'), request.accept_mimetypes)
+        if stream is not None:
+            def frame(event, data):
+                if stream == 'sse':
+                    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                return json.dumps(data) + '\n'
 
-        response_data = response.json()
+            def stream_profiles():
+                yield frame('stop', {"stop_id": stop_id, "operators": operator_names})
+                for operator, information in iter_operator_profiles(operator_names, generate):
+                    yield frame('profile', {"operator_name": operator, "information": information})
 
-        # get info for each operator
-        operator_names = []
-        for result in response_data['departures']:
-            if 'line' in result and 'operator' in result['line']:
-                if result['line']['operator']['name'] not in operator_names:
-                    operator_names.append(result['line']['operator']['name'])
-            
-            if len(operator_names) == 5:
-                break
-        
-        print(operator_names)
-        operator_info = {}
-        for operator in operator_names:
-            question = f"Give me a summary about the Dautsche Bahn operator {operator}!"
-            response = gemini.generate_content(question)
-            operator_info[operator] = response.text.replace('**', '').replace('\n', ' ')
+            mimetype = 'text/event-stream' if stream == 'sse' else 'application/x-ndjson'
+            return Response(stream_profiles(), status=200, mimetype=mimetype, headers={'Cache-Control': 'no-cache'})
+
+        # cached profiles, with any missing ones generated concurrently
+        operator_info = get_operator_profiles(operator_names, generate)
 
         # Construct the response in the desired format
         answer_data = {
@@ -523,7 +2428,7 @@ class Stop(Resource):
                 ]
         }
         # Convert the response_data to JSON string
-        json_data = json.dumps(answer_data)
+        json_data = to_json(answer_data)
 
         # Create a Flask Response object
         response = Response(response=json_data, status=200, mimetype='application/json')
@@ -533,15 +2438,492 @@ class Stop(Resource):
 
 
 
+@api.route('/stops/<stop_id>/history')
+class StopHistory(Resource):
+    @api.doc(params={'days': 'Number of days to look back (default 7)',
+                     'by': "'hour' for every hour, or 'hour_of_day' to fold the days together"})
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    @api.response(404, 'Not Found')
+    def get(self, stop_id):
+        if not history_enabled:
+            return {'error': 'Departures history is not enabled'}, 404
+        if not check_in_db("locations", stop_id):
+            return {"error": "Stop not found"}, 404
+        try:
+            days = int(request.args.get('days', 7))
+        except ValueError:
+            return {'error': 'days must be an integer'}, 400
+        if days < 1 or days > history_retention_days:
+            return {'error': f'{days} is an invalid input for days'}, 400
+        by = request.args.get('by', 'hour')
+        if by not in ('hour', 'hour_of_day'):
+            return {'error': f'{by} is an invalid input for by'}, 400
+
+        until = int(time.time())
+        since = until - days * 86400
+        rows = departure_delay_by_hour(stop_id, since, until, by)
 
+        # Construct the response in the desired format
+        response_data = {
+            "stop_id": stop_id,
+            "since": datetime.fromtimestamp(since, timezone.utc).isoformat(),
+            "until": datetime.fromtimestamp(until, timezone.utc).isoformat(),
+            "by": by,
+            "hours": [
+                {
+                    "hour": datetime.fromtimestamp(bucket, timezone.utc).isoformat() if by == 'hour' else bucket,
+                    "departures": departures,
+                    "average_delay": round(average_delay, 1) if average_delay is not None else None,
+                    "platform_changes": platform_changes,
+                }
+                for bucket, departures, average_delay, platform_changes in rows
+            ],
+            "_links": {
+                "stop": {
+                    "href": f"http://localhost:8888/stops/{stop_id}"
+                }
+            }
+        }
 
-        
+        # Convert the response_data to JSON string
+        json_data = to_json(response_data)
 
+        # Create a Flask Response object
+        response = Response(response=json_data, status=200, mimetype='application/json')
 
+        # Return the Flask Response object
+        return response
+
+
+# Render every metric in the Prometheus text format
+def render_metrics():
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    with metrics.lock:
+        histograms = {key: (list(value[0]), value[1], value[2]) for key, value in metrics.histograms.items()}
+        responses = dict(metrics.responses)
+        counters = dict(metrics.counters)
+        db_seconds, db_statements = metrics.db_seconds, metrics.db_statements
+
+    lines.append("# HELP http_request_duration_seconds Request latency per endpoint")
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (method, endpoint), (buckets, total, count) in sorted(histograms.items()):
+        labels = f'method="{method}",endpoint="{endpoint}"'
+        cumulative = 0
+        for bound, bucket in zip(latency_buckets, buckets):
+            cumulative += bucket
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'http_request_duration_seconds_sum{{{labels}}} {total}')
+        lines.append(f'http_request_duration_seconds_count{{{labels}}} {count}')
+
+    metric('http_responses_total', 'counter', 'Responses per endpoint and status',
+           [({'method': method, 'endpoint': endpoint, 'status': status}, count)
+            for (method, endpoint, status), count in sorted(responses.items())])
+
+    upstream_stats = upstream.stats()
+    metric('upstream_responses_total', 'counter', 'transport.rest responses per status, or error',
+           [({'status': status}, count) for status, count in sorted(upstream_stats['status_counts'].items(), key=str)])
+    metric('upstream_requests_total', 'counter', 'Requests sent on pooled connections', [({}, upstream_stats['requests'])])
+    metric('upstream_connections_opened_total', 'counter', 'New upstream connections', [({}, upstream_stats['connections_opened'])])
+    metric('upstream_connections_reused_total', 'counter', 'Requests sent on an open connection', [({}, upstream_stats['reused'])])
+    metric('upstream_retries_total', 'counter', 'Upstream attempts that were retried', [({}, upstream_stats['retries'])])
+
+    limiter_stats = upstream_limiter.stats()
+    metric('upstream_rate_limit_tokens', 'gauge', 'Tokens left in the rate limiter', [({}, limiter_stats['tokens'])])
+    metric('upstream_rate_limit_queue_depth', 'gauge', 'Requests waiting for a token',
+           [({'priority': 'interactive'}, limiter_stats['queued_interactive']),
+            ({'priority': 'background'}, limiter_stats['queued_background'])])
+    metric('upstream_rate_limit_expired_total', 'counter', 'Requests that gave up waiting for a token', [({}, limiter_stats['expired'])])
+
+    flight_samples = []
+    for group, flight in (('upstream', upstream_flight), ('gemini', gemini_flight)):
+        flight_stats = flight.stats()
+        flight_samples.append(({'group': group, 'result': 'executed'}, flight_stats['executed']))
+        flight_samples.append(({'group': group, 'result': 'coalesced'}, flight_stats['coalesced']))
+    metric('singleflight_calls_total', 'counter', 'Calls that ran, or joined an identical call in flight', flight_samples)
+
+    cache_stats = departures_cache.stats()
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    metric('departures_cache_requests_total', 'counter', 'Departures cache lookups',
+           [({'result': 'hit'}, cache_stats['hits']), ({'result': 'miss'}, cache_stats['misses'])])
+    metric('departures_cache_hit_ratio', 'gauge', 'Share of departures cache lookups that hit',
+           [({}, round(cache_stats['hits'] / lookups, 4) if lookups else 0)])
+    metric('departures_cache_evictions_total', 'counter', 'Entries evicted to stay under the size bound', [({}, cache_stats['evictions'])])
+    metric('departures_cache_bytes', 'gauge', 'Upstream body bytes held in the cache', [({}, cache_stats['bytes'])])
+
+    profile_hits = counters.get('operator_profile_cache_hits', 0)
+    profile_misses = counters.get('operator_profile_cache_misses', 0)
+    metric('operator_profile_cache_requests_total', 'counter', 'Operator profile lookups',
+           [({'result': 'hit'}, profile_hits), ({'result': 'miss'}, profile_misses)])
+    metric('operator_profile_timeouts_total', 'counter', 'Profiles not generated in time',
+           [({}, counters.get('operator_profile_timeouts', 0))])
+
+    metric('history_rows_written_total', 'counter', 'Departures written to the history',
+           [({}, counters.get('history_rows_written', 0))])
+    metric('history_fetches_dropped_total', 'counter', 'Fetches not recorded because the history writer was behind',
+           [({}, counters.get('history_fetches_dropped', 0))])
+    metric('history_queue_depth', 'gauge', 'Fetches waiting for the history writer', [({}, history_queue.qsize())])
+
+    metric('db_seconds_total', 'counter', 'Time spent in SQLite calls', [({}, round(db_seconds, 6))])
+    metric('db_statements_total', 'counter', 'SQLite calls made', [({}, db_statements)])
+    return '\n'.join(lines) + '\n'
+
+
+@api.route('/metrics')
+class MetricsEndpoint(Resource):
+    @api.response(200, 'OK')
+    def get(self):
+        return Response(response=render_metrics(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+# Settings for the optional asyncio serving mode (can be overridden in the .env file)
+serve_async        = os.environ.get("SERVE_ASYNC", "0") == "1"
+async_workers      = int(os.environ.get("ASYNC_WORKERS", 32))           # threads for SQLite and the Flask handlers
+async_limiter_poll = float(os.environ.get("ASYNC_LIMITER_POLL", 0.05))  # seconds between rate limiter checks
+async_stream_buffer = 1024 * 1024  # response bytes produced ahead of what the client has taken
+
+# The async mode serves the same Flask app behind aiohttp. For the three
+# endpoints that wait on slow services (PUT /stops, GET /stops/<id> and
+# GET /stops/<id>/departures) the waiting is done first on the event loop:
+# the upstream calls with aiohttp and the Gemini calls fanned out under a
+# semaphore. The results are left where the Flask handlers already look (the
+# departures cache, the stored operator profiles, or the WSGI environ), so the
+# handler then builds the usual response on a worker thread in milliseconds
+# instead of holding that thread for the whole upstream wait.
+run_async = None    # the event loop's run_in_executor, set when the app starts
+
+async def run_blocking(fn, *args):
+    return await run_async(None, fn, *args)
+
+# aiohttp counterpart of UpstreamClient.get(): the same rate limiter, retries
+# with jittered backoff and status counters, and identical concurrent calls at
+# the same priority share one request.
+class AsyncUpstreamClient:
+    def __init__(self, client):
+        import aiohttp
+        self.aiohttp = aiohttp
+        self.client = client
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=upstream_pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=upstream_connect_timeout, sock_read=upstream_read_timeout))
+        self.in_flight = {}     # (path, params, priority) -> task
+
+    # GET a path on the upstream API and return the body of a 200 response.
+    # Raises RateLimitExceeded or another requests.RequestException, as the
+    # sync client does.
+    async def get(self, path, params, priority=PRIORITY_INTERACTIVE):
+        key = (path, tuple(sorted(params.items())), priority)
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._get(path, params, priority))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self.in_flight.pop(key, None))
+        else:
+            upstream_flight.record_coalesced()
+        # a waiter that goes away must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def _get(self, path, params, priority):
+        url = f"{self.client.base_url}{path}"
+        params = {name: str(value) for name, value in params.items()}
+        queue_timeout = upstream_queue_timeout if priority == PRIORITY_INTERACTIVE else upstream_background_queue_timeout
+        for attempt in range(self.client.max_retries + 1):
+            last_attempt = attempt == self.client.max_retries
+            await upstream_limiter.acquire_async(priority, queue_timeout)
+            try:
+                async with self.session.get(url, params=params) as response:
+                    self.client.count_status(response.status)
+                    if response.status < 500 or last_attempt:
+                        if response.status != 200:
+                            raise requests.HTTPError(f'upstream returned {response.status}')
+                        return await response.read()
+                    print('upstream returned', response.status, url)
+            except (self.aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('upstream request failed:', url, e)
+                self.client.count_status('error')
+                if last_attempt:
+                    raise requests.ConnectionError(f'upstream request failed: {e}')
+
+            # exponential backoff with full jitter before the next attempt
+            with self.client.lock:
+                self.client.retries += 1
+            await asyncio.sleep(random.uniform(0, self.client.backoff * (2 ** attempt)))
+
+    async def close(self):
+        await self.session.close()
+
+# Does the waiting for one request on the event loop, see above
+class AsyncPrefetcher:
+    def __init__(self):
+        self.upstream = AsyncUpstreamClient(upstream)
+        self.gemini_slots = asyncio.Semaphore(operator_profile_workers)
+        self.profile_tasks = {}     # operator -> task, kept until done so late profiles are still stored
+
+    # Look up every query of a PUT /stops, keeping each result or exception
+    async def locations(self, queries):
+        priority = PRIORITY_INTERACTIVE if len(queries) == 1 else PRIORITY_BACKGROUND
+        bodies = await asyncio.gather(
+            *(self.upstream.get('/locations', {'query': query, 'results': 5}, priority) for query in queries),
+            return_exceptions=True)
+        return {query: body if isinstance(body, Exception) else json.loads(body) for query, body in zip(queries, bodies)}
+
+    # Get the departures_window for a stop as (fetched_at, body) from the
+    # cache, or upstream into the cache
+    async def departures(self, stop_id):
+        cached = departures_cache.get(stop_id)
+        if cached is not None:
+            return cached
+        fetched_at = datetime.now(timezone.utc)
+        body = await self.upstream.get(f'/stops/{stop_id}/departures', {'duration': departures_window})
+        if history_enabled:
+            # a big payload takes milliseconds to parse, keep that off the loop
+            record_departures(stop_id, fetched_at, await run_blocking(parse_departures, body))
+        departures_cache.put(stop_id, fetched_at, body)
+        return fetched_at, body
+
+    # Generate and store the missing or stale profiles concurrently, at most
+    # operator_profile_workers Gemini calls at a time across all requests,
+    # waiting up to operator_profile_timeout for them
+    async def operator_profiles(self, operator_names):
+        stored = await run_blocking(get_operator_profiles_db, operator_names)
+        now = time.time()
+        tasks = []
+        for operator in operator_names:
+            if operator in stored and now - stored[operator][1] < operator_profile_ttl:
+                continue
+            task = self.profile_tasks.get(operator)
+            if task is None:
+                task = asyncio.ensure_future(self.generate_profile(operator))
+                self.profile_tasks[operator] = task
+                task.add_done_callback(lambda done, operator=operator: self.profile_tasks.pop(operator, None))
+            else:
+                gemini_flight.record_coalesced()
+            tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks, timeout=operator_profile_timeout)
+
+    async def generate_profile(self, operator):
+        question = operator_profile_question(operator)
+        try:
+            async with self.gemini_slots:
+                model = await run_blocking(get_gemini)
+                if hasattr(model, 'generate_content_async'):
+                    text = (await model.generate_content_async(question)).text
+                else:
+                    text = await run_blocking(ask_gemini, question)
+            await run_blocking(save_operator_profile_db, operator, operator_profile_information(text))
+        except Exception as e:
+            print('Error generating operator profile:', operator, e)
+
+    # Do the waiting a request needs and return what to add to its environ
+    async def prefetch(self, method, path, query, body, content_type, accept):
+        parts = path.strip('/').split('/')
+        if method == 'PUT' and parts == ['stops']:
+            # local mode reads the database first, leave it all to the handler
+            if query.get('local') in ('1', 'true'):
+                return {}
+            json_body = None
+            if content_type == 'application/json':
+                try:
+                    json_body = json.loads(body)
+                except ValueError:
+                    pass
+            queries = put_queries(query.getall('query', []), json_body)
+            if not queries:
+                return {}
+            started = time.perf_counter()
+            locations = await self.locations(queries)
+            return {'prefetch.locations': locations, 'prefetch.timings': {'upstream': time.perf_counter() - started}}
+
+        if method != 'GET' or len(parts) not in (2, 3) or parts[0] != 'stops' or parts[1] in ('search', 'nearby'):
+            return {}
+        if len(parts) == 3 and parts[2] != 'departures':
+            return {}
+        stop_info = await run_blocking(get_stop_info_db, parts[1])
+        if not stop_info:
+            return {}
+        if len(parts) == 2 and next_departure_is_fresh(stop_info[5], stop_info[8]):
+            return {}
+
+        timings = {}
+        started = time.perf_counter()
+        try:
+            fetched_at, body = await self.departures(parts[1])
+        except requests.RequestException as e:
+            return {'prefetch.error': e}
+        timings['upstream'] = time.perf_counter() - started
+        # passed on as well, the cache entry may be evicted before the handler runs
+        environ_overrides = {'prefetch.departures': {parts[1]: (fetched_at, body)}, 'prefetch.timings': timings}
+        # a streamed response sends each profile as it is ready, so leave
+        # generating them to the handler
+        streamed = departures_stream_format(query.get('format'), parse_accept_header(accept, MIMEAccept))
+        if len(parts) == 3 and streamed is None:
+            started = time.perf_counter()
+            try:
+                operator_names = await run_blocking(
+                    lambda: find_operator_names(slice_departures(fetched_at, iter_departures_body(body), 90), 5))
+            except requests.RequestException:
+                # a bad payload, which the handler reports and drops from the cache
+                return environ_overrides
+            await self.operator_profiles(operator_names)
+            timings['gemini'] = time.perf_counter() - started
+            environ_overrides['prefetch.profiles'] = True
+        return environ_overrides
+
+    async def close(self):
+        await self.upstream.close()
+
+# Hands a response from the worker thread running the Flask app to the event
+# loop: first (status, headers), then the chunks of the body. The loop is only
+# woken when it is waiting and takes everything queued at once, so a body of
+# many small chunks, like an NDJSON export, doesn't cost a wakeup per line.
+# The thread waits once async_stream_buffer bytes are queued.
+class ResponseChunks:
+    def __init__(self, loop):
+        self.loop = loop
+        self.items = []
+        self.size = 0
+        self.finished = False
+        self.aborted = False
+        self.condition = threading.Condition()
+        self.ready = asyncio.Event()
+
+    # Queue an item, on the worker thread. Returns False if the client has gone.
+    def put(self, item):
+        with self.condition:
+            while self.size >= async_stream_buffer and not self.aborted:
+                self.condition.wait()
+            if self.aborted:
+                return False
+            wake = not self.items
+            self.items.append(item)
+            if isinstance(item, bytes):
+                self.size += len(item)
+        if wake:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        return True
+
+    # Mark the end of the response, on the worker thread
+    def finish(self):
+        with self.condition:
+            self.finished = True
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    # Stop a worker thread waiting in put(), on the event loop
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    # Wait for and take everything queued. Returns (items, ended), ended once
+    # the response has finished and nothing is left.
+    async def take(self):
+        while True:
+            with self.condition:
+                if self.items or self.finished:
+                    items, self.items, self.size = self.items, [], 0
+                    self.condition.notify_all()
+                    return items, self.finished
+                self.ready.clear()
+            await self.ready.wait()
+
+# Build the aiohttp app for the async mode around create_app(config)
+def create_async_app(config=None):
+    from aiohttp import web
+
+    flask_app = create_app(config)
+
+    async def start(app):
+        global run_async
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=async_workers))
+        run_async = loop.run_in_executor
+        app['prefetcher'] = AsyncPrefetcher()
+
+    async def stop(app):
+        await app['prefetcher'].close()
+
+    # Run the Flask app on a worker thread for one request, handing the
+    # status and headers and then each chunk of the body to `chunks` as the
+    # app yields them. The whole response runs on this one thread, as WSGI
+    # expects.
+    def call_flask(request, body, environ_overrides, chunks):
+        try:
+            environ = EnvironBuilder(
+                path=request.path, method=request.method, query_string=request.query_string,
+                headers=list(request.headers.items()), data=body,
+                environ_base={'REMOTE_ADDR': request.remote or ''}, environ_overrides=environ_overrides,
+            ).get_environ()
+            app_iter, status, headers = run_wsgi_app(flask_app, environ)
+            with closing(app_iter):
+                chunks.put((int(status.split(' ', 1)[0]), list(headers.items())))
+                for chunk in app_iter:
+                    # stop producing the body once the client has gone
+                    if not chunks.put(chunk):
+                        return
+        finally:
+            chunks.finish()
+
+    async def handle(request):
+        started = time.perf_counter()
+        body = await request.read()
+        environ_overrides = await request.app['prefetcher'].prefetch(
+            request.method, request.path, request.query, body, request.content_type, request.headers.get('Accept'))
+        environ_overrides['prefetch.started'] = started
+
+        # Send the body as the handler produces it, so NDJSON exports and
+        # SSE streams are never held in memory whole
+        chunks = ResponseChunks(asyncio.get_running_loop())
+        call = asyncio.ensure_future(run_blocking(call_flask, request, body, environ_overrides, chunks))
+        try:
+            items, ended = await chunks.take()
+            if not items:
+                # the app raised before it started the response
+                await call
+                return web.Response(status=500)
+            status, headers = items.pop(0)
+            response = web.StreamResponse(status=status, headers=headers)
+            await response.prepare(request)
+            try:
+                while True:
+                    data = b''.join(items)
+                    if data:
+                        await response.write(data)
+                    if ended:
+                        break
+                    items, ended = await chunks.take()
+                await response.write_eof()
+            except ConnectionResetError:
+                # the client went away mid-stream, nothing left to tell it
+                return response
+            await call
+            return response
+        finally:
+            # if the client went away, the worker thread stops and closes the app
+            chunks.abort()
+
+    app = web.Application()
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.router.add_route('*', '/{path:.*}', handle)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=8888, debug=True)
+    if serve_async:
+        from aiohttp import web
+        web.run_app(create_async_app(), host='127.0.0.1', port=8888)
+    else:
+        create_app().run(host='127.0.0.1', port=8888, debug=True)
 
 
 ######################################################################################